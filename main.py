@@ -1,20 +1,50 @@
 from fasthtml.common import *
 import openpyxl  # Additional Plugin for pandas to read Excel
 import pandas as pd
-from io import BytesIO
+import numpy as np
+import io
+import asyncio
+import json
+import csv
+import zipfile
 import tempfile
-import xlwings as xw
+from xml.sax.saxutils import escape
 import sqlite3
-
-selected_questions_id = []
-
-
-def render_row(questions):
+import hashlib
+import itertools
+import uuid
+import threading
+import queue
+import time
+import bisect
+import logging
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+from starlette.routing import Match
+from urllib.parse import urlencode
+from typing import NamedTuple
+from contextlib import contextmanager, nullcontext
+from email.utils import formatdate
+
+
+def render_row(questions, selected: set, next_page_url=None):
+    # The last row of a page loads the next page once it is scrolled into view.
+    # Its hx-swap must not reach the select link inside the row
+    lazy_load = (
+        {
+            "hx_get": next_page_url,
+            "hx_trigger": "revealed",
+            "hx_swap": "afterend",
+            "hx_disinherit": "*",
+        }
+        if next_page_url
+        else {}
+    )
     return Tr(
         Td(
             Form(
                 A(
-                    "✅" if questions.id in selected_questions_id else "⬜",
+                    "✅" if questions.id in selected else "⬜",
                     hx_post="/select_question",
                 ),
                 Hidden(id="question_id", value=questions.id),
@@ -27,6 +57,7 @@ def render_row(questions):
         Td(questions.d),
         Td(questions.answers),
         Td(questions.tag),
+        **lazy_load,
     )
 
 
@@ -97,7 +128,9 @@ login_redir = RedirectResponse("/student/login", status_code=303)
 def before(request, session):
     # Get authentication from session
     auth = request.scope["auth"] = session.get("auth", None)
-    if not auth:
+    # Resolved once at login, so handlers never look the student up by name
+    student_id = request.scope["student_id"] = session.get("student_id", None)
+    if not auth or not student_id:
         return login_redir
 
 
@@ -111,34 +144,1556 @@ bware = Beforeware(
     ],
 )
 
-(
-    app,
-    route,
-    questions_table,
-    quizzes_table,
-    quiz_questions_table,
-    students_table,
-    student_quiz_result_table,
-    student_quiz_response_table,
-) = fast_app(
-    "data/quiz.db",
-    live=True,
-    tbls=tables_schema,
+# Set LMS_ENV=production to turn off live reloading and tune SQLite for many concurrent users
+PRODUCTION = os.environ.get("LMS_ENV") == "production"
+DB_PATH = os.environ.get("LMS_DB_PATH", "data/quiz.db")
+# Set LMS_QUIZ_MODE=whole to send a whole quiz in one page and navigate it in the browser
+WHOLE_QUIZ_MODE = os.environ.get("LMS_QUIZ_MODE") == "whole"
+# Set LMS_SLOW_REQUEST_MS to log every slower request together with its queries
+SLOW_REQUEST_SECONDS = float(os.environ.get("LMS_SLOW_REQUEST_MS", 0)) / 1000
+# A statement repeated this often within one request is reported as an N+1 pattern
+N_PLUS_ONE_THRESHOLD = int(os.environ.get("LMS_N_PLUS_ONE_THRESHOLD", 10))
+
+logger = logging.getLogger("lms")
+
+
+## Instrumentation ##
+
+
+# The (sql, seconds) list of the request being served, None outside of requests
+request_queries = ContextVar("request_queries", default=None)
+
+
+# Util function
+def record_query(sql: str, seconds: float):
+    queries = request_queries.get()
+    if queries is not None:
+        queries.append((sql, seconds))
+
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+
+
+class TracedConnection(sqlite3.Connection):
+    # Every statement goes through a TracedCursor, including the ones run by pandas
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Per (method, route): request count in each latency bucket, the last one is +Inf
+        self.buckets = {}
+        self.seconds = Counter()
+        self.responses = Counter()
+        self.sql_queries = Counter()
+        self.sql_seconds = Counter()
+        self.n_plus_one = Counter()
+
+    def observe(self, method, route, status, seconds, queries):
+        key = (method, route)
+        statements = Counter(" ".join(sql.split()) for sql, _ in queries)
+        repeated_sql, repeats = (statements.most_common(1) or [(None, 0)])[0]
+        with self.lock:
+            buckets = self.buckets.setdefault(key, [0] * (len(latency_buckets) + 1))
+            buckets[bisect.bisect_left(latency_buckets, seconds)] += 1
+            self.seconds[key] += seconds
+            self.responses[(method, route, status)] += 1
+            self.sql_queries[key] += len(queries)
+            self.sql_seconds[key] += sum(query_seconds for _, query_seconds in queries)
+            if repeats >= N_PLUS_ONE_THRESHOLD:
+                self.n_plus_one[key] += 1
+        if repeats >= N_PLUS_ONE_THRESHOLD:
+            logger.warning(
+                "Possible N+1 in %s %s, ran %d times: %s",
+                method,
+                route,
+                repeats,
+                repeated_sql,
+            )
+        if SLOW_REQUEST_SECONDS and seconds >= SLOW_REQUEST_SECONDS:
+            logger.warning(
+                "Slow request %s %s took %.0f ms with %d queries:\n%s",
+                method,
+                route,
+                seconds * 1000,
+                len(queries),
+                "\n".join(
+                    f"  {query_seconds * 1000:8.2f} ms  {' '.join(sql.split())}"
+                    for sql, query_seconds in queries
+                ),
+            )
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = [
+            "# HELP lms_request_duration_seconds Request latency by route.",
+            "# TYPE lms_request_duration_seconds histogram",
+        ]
+        with self.lock:
+            for (method, route), buckets in sorted(self.buckets.items()):
+                labels = f'method="{method}",route="{route}"'
+                for le, count in zip(
+                    [*map(str, latency_buckets), "+Inf"], itertools.accumulate(buckets)
+                ):
+                    lines.append(
+                        f'lms_request_duration_seconds_bucket{{{labels},le="{le}"}} {count}'
+                    )
+                lines.append(
+                    f"lms_request_duration_seconds_sum{{{labels}}} {self.seconds[(method, route)]}"
+                )
+                lines.append(
+                    f"lms_request_duration_seconds_count{{{labels}}} {sum(buckets)}"
+                )
+            counters = [
+                (
+                    "lms_responses_total",
+                    "Responses by route and status.",
+                    self.responses,
+                ),
+                (
+                    "lms_sql_queries_total",
+                    "SQL statements run by route.",
+                    self.sql_queries,
+                ),
+                (
+                    "lms_sql_seconds_total",
+                    "Time spent in SQL by route.",
+                    self.sql_seconds,
+                ),
+                (
+                    "lms_n_plus_one_requests_total",
+                    f"Requests repeating a statement {N_PLUS_ONE_THRESHOLD}+ times.",
+                    self.n_plus_one,
+                ),
+            ]
+            for name, help_text, counter in counters:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(counter.items()):
+                    labels = ",".join(
+                        f'{label}="{label_value}"'
+                        for label, label_value in zip(
+                            ["method", "route", "status"], key
+                        )
+                    )
+                    lines.append(f"{name}{{{labels}}} {value}")
+        return "\n".join(lines) + "\n"
+
+
+request_metrics = RequestMetrics()
+
+
+# Util function
+def route_template(scope):
+    # Label by the route pattern so /quiz_result/1 and /quiz_result/2 are one series
+    for candidate in scope["app"].routes:
+        match, _ = candidate.matches(scope)
+        if match == Match.FULL:
+            return getattr(candidate, "path", scope["path"])
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        queries = []
+        token = request_queries.set(queries)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            request_queries.reset(token)
+            request_metrics.observe(
+                scope["method"],
+                route_template(scope),
+                status,
+                time.perf_counter() - started,
+                queries,
+            )
+
+
+app, route = fast_app(
+    live=not PRODUCTION,
     hdrs=[custom_css],
     before=bware,
+    middleware=[Middleware(MetricsMiddleware)],
 )
 
 
-# Unpacking the table_object and dataclass
-questions, Questions = questions_table
-quizzes, Quizzes = quizzes_table
-quiz_questions, QuizQuestions = quiz_questions_table
-students, Students = students_table
-student_quiz_result, StudentQuizResult = student_quiz_result_table
-student_quiz_response, StudentQuizResponse = student_quiz_response_table
+@route("/metrics")
+def get():
+    return Response(request_metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+## Database Connections ##
+
+
+# Util function
+def configure_connection(conn, read_only: bool = False):
+    conn.execute("PRAGMA busy_timeout = 30000")
+    conn.execute("PRAGMA foreign_keys = ON")
+    if PRODUCTION:
+        # With WAL only the last commits can be lost on power failure, never corrupted
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA mmap_size = 268435456")
+        conn.execute("PRAGMA cache_size = -65536")
+        conn.execute("PRAGMA temp_store = MEMORY")
+    if read_only:
+        conn.execute("PRAGMA query_only = 1")
+    return conn
+
+
+# Util function
+def open_connection():
+    return sqlite3.connect(
+        DB_PATH,
+        isolation_level=None,
+        check_same_thread=False,
+        timeout=30,
+        factory=TracedConnection,
+    )
+
+
+# Util function
+def connect(read_only: bool = False):
+    # A connection of its own for background threads and long streamed reads
+    conn = open_connection()
+    conn.row_factory = sqlite3.Row
+    return configure_connection(conn, read_only)
+
+
+# The single writer connection, every request handler writes through it under write_lock
+Path(DB_PATH).parent.mkdir(exist_ok=True)
+db = Database(open_connection())
+db.enable_wal()  # So readers never block the writer
+configure_connection(db.conn)
+db.write_lock = threading.RLock()
+
+
+class ReaderPool:
+    # Read-only connections handed out to one thread at a time, opened lazily
+    def __init__(self, size: int):
+        self.size = size
+        self.opened = 0
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        try:
+            reader = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = self.opened < self.size
+                self.opened += can_open
+            # Wait for a reader to come back once the pool is full
+            reader = Database(connect(read_only=True)) if can_open else self.idle.get()
+        try:
+            yield reader
+        finally:
+            self.idle.put(reader)
+
+
+reader_pool = ReaderPool(size=int(os.environ.get("LMS_DB_READERS", 8)))
+
+
+# Util function
+def read_db():
+    return reader_pool.connection()
+
+
+# Util function
+def query(sql: str, params=None):
+    with read_db() as reader:
+        return reader.q(sql, params)
+
+
+## Database Migrations ##
+
+
+@contextmanager
+def transaction(db):
+    # Request handlers share one connection, so only one of them may hold a transaction on it
+    with getattr(db, "write_lock", nullcontext()):
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+
+# Util function
+def rebuild_table(db, name: str, create_sql: str, copy_sql: str):
+    # SQLite can't add constraints to an existing table, so copy it into a new one
+    db.execute(create_sql.format(name=f"{name}_new"))
+    db.execute(copy_sql.format(name=f"{name}_new"))
+    db.execute(f"DROP TABLE {name}")
+    db.execute(f"ALTER TABLE {name}_new RENAME TO {name}")
+
+
+question_columns = ["question", "a", "b", "c", "d", "answers", "tag"]
+
+
+# Util function
+def question_hash(question: dict):
+    # Fingerprint of everything a teacher can edit in the workbook
+    content = "\x1f".join(str(question[column] or "") for column in question_columns)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+# Answer keys and selections are scored as option bitmasks, A is bit 0, B is bit 1, ...
+option_letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+# Util function
+def option_mask(options: str) -> int:
+    mask = 0
+    for option in (options or "").upper():
+        if option in option_letters:
+            mask |= 1 << option_letters.index(option)
+    return mask
+
+
+# Util function
+def mask_options(mask: int) -> str:
+    return "".join(
+        letter for bit, letter in enumerate(option_letters) if int(mask) >> bit & 1
+    )
+
+
+# The responses of an attempt live in its student_quiz_result row: question_ids packs
+# the quiz's question ids as uint32 and selected_masks holds one mask byte per question,
+# so a question can have at most 8 options (A to H). The bank has columns for four
+question_id_dtype = np.dtype("<u4")
+max_stored_mask = 0xFF
+
+
+# Util function
+def pack_question_ids(question_ids) -> bytes:
+    return np.asarray(question_ids, dtype=question_id_dtype).tobytes()
+
+
+# Util function
+def unpack_question_ids(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=question_id_dtype)
+
+
+# Util function
+def pack_masks(masks) -> bytes:
+    return np.asarray(masks, dtype=np.uint8).tobytes()
+
+
+# Util function
+def unpack_masks(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=np.uint8)
+
+
+def migration_create_tables(db):
+    for name, schema in tables_schema.items():
+        db.t[name].create(**schema, if_not_exists=True)
+    # To make the username unique
+    db.t.student.create_index(["username"], unique=True, if_not_exists=True)
+
+
+def migration_add_foreign_keys_and_indexes(db):
+    # Rows pointing to a deleted parent or duplicated mappings are dropped while copying
+    rebuild_table(
+        db,
+        "quiz_questions",
+        """CREATE TABLE {name} (
+            id INTEGER PRIMARY KEY,
+            quiz_id INTEGER NOT NULL REFERENCES quizzes(id) ON DELETE CASCADE,
+            question_id INTEGER NOT NULL
+        )""",
+        """INSERT INTO {name} SELECT id, quiz_id, question_id FROM quiz_questions
+        WHERE id IN (SELECT MIN(id) FROM quiz_questions GROUP BY quiz_id, question_id)
+        AND quiz_id IN (SELECT id FROM quizzes)""",
+    )
+    rebuild_table(
+        db,
+        "student_quiz_result",
+        """CREATE TABLE {name} (
+            id INTEGER PRIMARY KEY,
+            student_id INTEGER NOT NULL REFERENCES student(student_id) ON DELETE CASCADE,
+            quiz_id INTEGER NOT NULL REFERENCES quizzes(id) ON DELETE CASCADE,
+            completed INTEGER NOT NULL DEFAULT 0,
+            score TEXT
+        )""",
+        """INSERT INTO {name} SELECT id, student_id, quiz_id, COALESCE(completed, 0), score
+        FROM student_quiz_result
+        WHERE student_id IN (SELECT student_id FROM student)
+        AND quiz_id IN (SELECT id FROM quizzes)""",
+    )
+    rebuild_table(
+        db,
+        "student_quiz_response",
+        """CREATE TABLE {name} (
+            id INTEGER PRIMARY KEY,
+            student_quiz_id INTEGER NOT NULL
+                REFERENCES student_quiz_result(id) ON DELETE CASCADE,
+            question_id INTEGER NOT NULL,
+            selected_option TEXT NOT NULL DEFAULT ''
+        )""",
+        """INSERT INTO {name}
+        SELECT id, student_quiz_id, question_id, COALESCE(selected_option, '')
+        FROM student_quiz_response
+        WHERE id IN (
+            SELECT MIN(id) FROM student_quiz_response
+            GROUP BY student_quiz_id, question_id
+        )
+        AND student_quiz_id IN (SELECT id FROM student_quiz_result)""",
+    )
+    for sql in [
+        "CREATE UNIQUE INDEX idx_quiz_questions_quiz_question ON quiz_questions (quiz_id, question_id)",
+        "CREATE INDEX idx_quiz_questions_question ON quiz_questions (question_id)",
+        "CREATE INDEX idx_student_quiz_result_student_quiz ON student_quiz_result (student_id, quiz_id)",
+        "CREATE INDEX idx_student_quiz_result_quiz_completed ON student_quiz_result (quiz_id, completed)",
+        "CREATE UNIQUE INDEX idx_student_quiz_response_quiz_question ON student_quiz_response (student_quiz_id, question_id)",
+        "CREATE INDEX idx_student_quiz_response_question ON student_quiz_response (question_id)",
+    ]:
+        db.execute(sql)
+
+
+def migration_create_jobs(db):
+    # Progress of background jobs, readable from any worker process
+    db.execute(
+        """CREATE TABLE jobs (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            processed INTEGER NOT NULL DEFAULT 0,
+            total INTEGER,
+            done INTEGER NOT NULL DEFAULT 0,
+            message TEXT NOT NULL DEFAULT '',
+            error TEXT,
+            next_url TEXT
+        )"""
+    )
+
+
+def migration_add_question_hash(db):
+    db.execute("ALTER TABLE questions ADD COLUMN content_hash TEXT")
+    db.conn.executemany(
+        "UPDATE questions SET content_hash = ? WHERE id = ?",
+        [
+            (question_hash(row), row["id"])
+            for row in db.query("SELECT * FROM questions")
+        ],
+    )
+    db.execute("CREATE INDEX idx_questions_question ON questions (question)")
+
+
+def migration_create_question_selection(db):
+    # Questions picked for the next quiz, kept per browser session
+    db.execute(
+        """CREATE TABLE question_selection (
+            session_id TEXT NOT NULL,
+            question_id INTEGER NOT NULL,
+            PRIMARY KEY (session_id, question_id)
+        ) WITHOUT ROWID"""
+    )
+
+
+def migration_unique_student_attempt(db):
+    # Keep the first attempt when a double click created more than one
+    duplicates = """SELECT id FROM student_quiz_result WHERE id NOT IN (
+        SELECT MIN(id) FROM student_quiz_result GROUP BY student_id, quiz_id
+    )"""
+    db.execute(
+        f"DELETE FROM student_quiz_response WHERE student_quiz_id IN ({duplicates})"
+    )
+    db.execute(f"DELETE FROM student_quiz_result WHERE id IN ({duplicates})")
+    db.execute("DROP INDEX idx_student_quiz_result_student_quiz")
+    db.execute(
+        """CREATE UNIQUE INDEX idx_student_quiz_result_student_quiz
+        ON student_quiz_result (student_id, quiz_id)"""
+    )
+
+
+def migration_add_numeric_scores(db):
+    # Numeric copies of the "x/y" score string, kept in sync by submit and regrade
+    db.execute("ALTER TABLE student_quiz_result ADD COLUMN score_points REAL")
+    db.execute("ALTER TABLE student_quiz_result ADD COLUMN score_total INTEGER")
+    db.execute(
+        """UPDATE student_quiz_result SET
+            score_points = CAST(substr(score, 1, instr(score, '/') - 1) AS REAL),
+            score_total = CAST(substr(score, instr(score, '/') + 1) AS INTEGER)
+        WHERE instr(score, '/') > 0"""
+    )
+
+
+def migration_create_question_search(db):
+    # External content FTS5 index over the question bank, the triggers keep it in sync
+    db.execute(
+        """CREATE VIRTUAL TABLE question_search USING fts5(
+            question, a, b, c, d, tag,
+            content = 'questions', content_rowid = 'id', tokenize = 'porter unicode61'
+        )"""
+    )
+    db.execute(
+        """CREATE TRIGGER questions_search_insert AFTER INSERT ON questions BEGIN
+            INSERT INTO question_search (rowid, question, a, b, c, d, tag)
+            VALUES (new.id, new.question, new.a, new.b, new.c, new.d, new.tag);
+        END"""
+    )
+    db.execute(
+        """CREATE TRIGGER questions_search_delete AFTER DELETE ON questions BEGIN
+            INSERT INTO question_search (question_search, rowid, question, a, b, c, d, tag)
+            VALUES ('delete', old.id, old.question, old.a, old.b, old.c, old.d, old.tag);
+        END"""
+    )
+    db.execute(
+        """CREATE TRIGGER questions_search_update
+        AFTER UPDATE OF question, a, b, c, d, tag ON questions BEGIN
+            INSERT INTO question_search (question_search, rowid, question, a, b, c, d, tag)
+            VALUES ('delete', old.id, old.question, old.a, old.b, old.c, old.d, old.tag);
+            INSERT INTO question_search (rowid, question, a, b, c, d, tag)
+            VALUES (new.id, new.question, new.a, new.b, new.c, new.d, new.tag);
+        END"""
+    )
+    db.execute("INSERT INTO question_search (question_search) VALUES ('rebuild')")
+
+
+def migration_pack_student_responses(db):
+    # One row per attempt instead of one row per answer, see pack_question_ids
+    db.execute(
+        "ALTER TABLE student_quiz_result ADD COLUMN question_ids BLOB NOT NULL DEFAULT x''"
+    )
+    db.execute(
+        "ALTER TABLE student_quiz_result ADD COLUMN selected_masks BLOB NOT NULL DEFAULT x''"
+    )
+    responses = db.execute(
+        """SELECT student_quiz_id, question_id, selected_option
+        FROM student_quiz_response ORDER BY student_quiz_id, question_id"""
+    ).fetchall()
+    packed = []
+    for attempt_id, rows in itertools.groupby(responses, key=lambda row: row[0]):
+        rows = list(rows)
+        packed.append(
+            (
+                pack_question_ids([row[1] for row in rows]),
+                pack_masks([option_mask(row[2]) for row in rows]),
+                attempt_id,
+            )
+        )
+    db.conn.executemany(
+        """UPDATE student_quiz_result SET question_ids = ?, selected_masks = ?
+        WHERE id = ?""",
+        packed,
+    )
+    db.execute("DROP TABLE student_quiz_response")
+
+
+def migration_create_item_stats(db):
+    # Item-analysis counters, added to on every submit and rebuilt from history on demand
+    db.execute(
+        """CREATE TABLE item_stats (
+            quiz_id INTEGER NOT NULL REFERENCES quizzes(id) ON DELETE CASCADE,
+            question_id INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            full_credit INTEGER NOT NULL DEFAULT 0,
+            partial_credit INTEGER NOT NULL DEFAULT 0,
+            unanswered INTEGER NOT NULL DEFAULT 0,
+            sum_points REAL NOT NULL DEFAULT 0,
+            sum_points_sq REAL NOT NULL DEFAULT 0,
+            sum_totals REAL NOT NULL DEFAULT 0,
+            sum_totals_sq REAL NOT NULL DEFAULT 0,
+            sum_points_totals REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (quiz_id, question_id)
+        ) WITHOUT ROWID"""
+    )
+    db.execute(
+        """CREATE TABLE item_option_stats (
+            quiz_id INTEGER NOT NULL REFERENCES quizzes(id) ON DELETE CASCADE,
+            question_id INTEGER NOT NULL,
+            option TEXT NOT NULL,
+            selected INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (quiz_id, question_id, option)
+        ) WITHOUT ROWID"""
+    )
+
+
+def migration_add_student_group(db):
+    # Class or group assigned by the roster import, students who only logged in have none
+    db.execute("ALTER TABLE student ADD COLUMN student_group TEXT")
+    db.execute("CREATE INDEX idx_student_group ON student (student_group)")
+
+
+def migration_add_cache_versions(db):
+    # Versions of cached content, shared by every worker through the database.
+    # A regrade bumps the attempt's version, an import bumps the question bank's
+    db.execute(
+        "ALTER TABLE student_quiz_result ADD COLUMN version INTEGER NOT NULL DEFAULT 0"
+    )
+    db.execute(
+        """CREATE TABLE content_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID"""
+    )
+    db.execute("INSERT INTO content_versions (name) VALUES ('questions')")
+
+
+def migration_add_attempt_started_at(db):
+    # Attempts pre-created by the roster import exist before the student opens the quiz.
+    # Earlier attempts count as started once they were answered or submitted
+    db.execute("ALTER TABLE student_quiz_result ADD COLUMN started_at TEXT")
+    db.execute(
+        """UPDATE student_quiz_result SET started_at = CURRENT_TIMESTAMP
+        WHERE completed = 1 OR selected_masks != zeroblob(length(selected_masks))"""
+    )
+
+
+def migration_create_pending_answers(db):
+    # Autosaved answers not yet folded into selected_masks, shared by every worker
+    db.execute(
+        """CREATE TABLE pending_answers (
+            attempt_id INTEGER NOT NULL
+                REFERENCES student_quiz_result(id) ON DELETE CASCADE,
+            slot INTEGER NOT NULL,
+            mask INTEGER NOT NULL,
+            PRIMARY KEY (attempt_id, slot)
+        ) WITHOUT ROWID"""
+    )
+
+
+def migration_add_question_tag_index(db):
+    # The tag filter pages by id, so a tag's page is a range scan instead of a table scan
+    db.execute("CREATE INDEX idx_questions_tag ON questions (tag, id)")
+
+
+# The position in this list is the schema version stored in PRAGMA user_version
+# Never edit or reorder a released migration, append a new one instead
+migrations = [
+    migration_create_tables,
+    migration_add_foreign_keys_and_indexes,
+    migration_create_jobs,
+    migration_add_question_hash,
+    migration_create_question_selection,
+    migration_unique_student_attempt,
+    migration_add_numeric_scores,
+    migration_create_question_search,
+    migration_pack_student_responses,
+    migration_create_item_stats,
+    migration_add_student_group,
+    migration_add_cache_versions,
+    migration_add_attempt_started_at,
+    migration_create_pending_answers,
+    migration_add_question_tag_index,
+]
+
+
+def migrate(db):
+    # Foreign keys have to be off while tables are rebuilt and can't be toggled inside a transaction
+    db.execute("PRAGMA foreign_keys = OFF")
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    for version, migration in enumerate(migrations[version:], start=version + 1):
+        with transaction(db):
+            migration(db)
+            violations = db.execute("PRAGMA foreign_key_check").fetchall()
+            if violations:
+                raise sqlite3.IntegrityError(
+                    f"Migration {version} left foreign key violations: {violations}"
+                )
+            db.execute(f"PRAGMA user_version = {version}")
+    db.execute("PRAGMA foreign_keys = ON")
+
+
+migrate(db)
+
+# Dataclasses for the forms and rows, every read and write goes through SQL
+Questions = db.t.questions.dataclass()
+Quizzes = db.t.quizzes.dataclass()
+Students = db.t.student.dataclass()
+
+
+## Quiz Cache ##
+
+
+class QuizQuestion(NamedTuple):
+    id: int
+    question: str
+    options: tuple  # (option, text) pairs for the non-empty options only
+    answers: str
+
+
+class QuizSnapshot(NamedTuple):
+    id: int
+    quiz_name: str
+    questions: tuple  # QuizQuestion ordered by question id
+
+
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        # Bumped on every invalidation so a load that raced with it isn't stored
+        self.generation = 0
+
+    def get(self, key, load):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+            generation = self.generation
+        value = load(key)
+        with self.lock:
+            if generation == self.generation:
+                self.items[key] = value
+                if len(self.items) > self.maxsize:
+                    self.items.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            self.generation += 1
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.items.clear()
+
+
+def load_quiz_snapshot(quiz_id: int):
+    with read_db() as reader:
+        quiz = reader.q("SELECT id, quiz_name FROM quizzes WHERE id = ?", [quiz_id])
+        if not quiz:
+            raise NotFoundError()
+        rows = reader.q(
+            """SELECT q.* FROM quiz_questions qq
+            JOIN questions q ON q.id = qq.question_id
+            WHERE qq.quiz_id = ? ORDER BY q.id""",
+            [quiz_id],
+        )
+    snapshot_questions = tuple(
+        QuizQuestion(
+            id=row["id"],
+            question=row["question"],
+            options=tuple(
+                (option.upper(), row[option])
+                for option in ["a", "b", "c", "d"]
+                if row[option]
+            ),
+            answers=row["answers"],
+        )
+        for row in rows
+    )
+    return QuizSnapshot(
+        id=quiz[0]["id"], quiz_name=quiz[0]["quiz_name"], questions=snapshot_questions
+    )
+
+
+quiz_cache = LRUCache(maxsize=256)
+
+
+# Util function
+def bank_version():
+    # Changes with every import, in every worker
+    return query("SELECT version FROM content_versions WHERE name = 'questions'")[0][
+        "version"
+    ]
+
+
+# Util function
+def get_quiz_snapshot(quiz_id: int) -> QuizSnapshot:
+    return quiz_cache.get(
+        (quiz_id, bank_version()), lambda key: load_quiz_snapshot(quiz_id)
+    )
+
+
+class CachedPage(NamedTuple):
+    content: tuple
+    etag: str
+    last_modified: str
+
+
+# Rendered pages keyed by ("preview", quiz_id, bank version) or
+# ("result", student_quiz_id, attempt version, bank version). The versions come from
+# the database, so a change made by any worker makes every worker render a new page
+page_cache = LRUCache(maxsize=1024)
+
+
+def render_cached_page(req, key, render):
+    def load(key):
+        content = render()
+        digest = hashlib.sha1(
+            (repr(key) + "".join(map(to_xml, content))).encode()
+        ).hexdigest()
+        return CachedPage(content, digest, formatdate(usegmt=True))
+
+    page = page_cache.get(key, load)
+    # Full page and htmx fragment are different representations of the same content
+    variant = "-hx" if req.headers.get("hx-request") else ""
+    headers = {
+        "ETag": f'"{page.etag}{variant}"',
+        "Last-Modified": page.last_modified,
+        "Cache-Control": "private, no-cache",
+        "Vary": "HX-Request",
+    }
+    if req.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return *page.content, *(HttpHeader(k, v) for k, v in headers.items())
+
+
+## Background Jobs ##
+
+
+def update_job(conn, job_id: str, **fields):
+    columns = ", ".join(f"{column} = ?" for column in fields)
+    conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", [*fields.values(), job_id])
+
+
+def start_job(name: str, target, *args):
+    # Runs target(conn, job_id, *args) in a thread and records its progress in the jobs table
+    job_id = uuid.uuid4().hex
+    with transaction(db):
+        db.execute("INSERT INTO jobs (id, name) VALUES (?, ?)", [job_id, name])
+
+    def run():
+        conn = connect()
+        try:
+            target(conn, job_id, *args)
+        except Exception as e:
+            update_job(conn, job_id, error=str(e))
+        finally:
+            update_job(conn, job_id, done=1)
+            conn.close()
+
+    threading.Thread(target=run, daemon=True).start()
+    return job_id
+
+
+def render_job_progress(job_id: str):
+    job = query("SELECT * FROM jobs WHERE id = ?", [job_id])[0]
+    if job["error"]:
+        return Div(P(f"{job["name"]} failed: {job["error"]}"), id=f"job-{job_id}")
+    if job["done"]:
+        return Div(
+            P(job["message"]),
+            # It will redirect after 1 sec
+            (
+                Meta(http_equiv="refresh", content=f"1; url={job["next_url"]}")
+                if job["next_url"]
+                else None
+            ),
+            id=f"job-{job_id}",
+        )
+    # Keep polling until the job is done
+    return Div(
+        P(f"{job["name"]}: {job["processed"]} rows processed"),
+        Progress(value=job["processed"], max=job["total"] or None),
+        hx_get=f"/jobs/{job_id}",
+        hx_trigger="every 1s",
+        hx_swap="outerHTML",
+        id=f"job-{job_id}",
+    )
+
+
+@route("/jobs/{job_id}")
+def get(job_id: str):
+    return render_job_progress(job_id)
+
+
+## Question Selection ##
+
+
+class SQLiteSelectionStore:
+    # Set of selected question ids per session, shared by every worker process.
+    # Another backend only needs the same methods.
+    def __init__(self, db):
+        self.db = db
+
+    def toggle(self, session_id: str, question_id: int) -> bool:
+        with transaction(self.db):
+            deleted = self.db.execute(
+                "DELETE FROM question_selection WHERE session_id = ? AND question_id = ?",
+                [session_id, question_id],
+            ).rowcount
+            if not deleted:
+                self.db.execute(
+                    "INSERT OR IGNORE INTO question_selection VALUES (?, ?)",
+                    [session_id, question_id],
+                )
+        return not deleted
+
+    def select_where(self, session_id: str, where: str, where_args: list):
+        with transaction(self.db):
+            self.db.execute(
+                f"""INSERT OR IGNORE INTO question_selection
+                SELECT ?, id FROM questions WHERE {where}""",
+                [session_id, *where_args],
+            )
+
+    def deselect_where(self, session_id: str, where: str, where_args: list):
+        with transaction(self.db):
+            self.db.execute(
+                f"""DELETE FROM question_selection WHERE session_id = ?
+                AND question_id IN (SELECT id FROM questions WHERE {where})""",
+                [session_id, *where_args],
+            )
+
+    def selected_among(self, session_id: str, question_ids: list) -> set:
+        # Only the ids of the rows being rendered are looked up
+        placeholders = ", ".join("?" * len(question_ids))
+        rows = query(
+            f"""SELECT question_id FROM question_selection
+            WHERE session_id = ? AND question_id IN ({placeholders})""",
+            [session_id, *question_ids],
+        )
+        return {row["question_id"] for row in rows}
+
+    def selected(self, session_id: str) -> list:
+        rows = query(
+            """SELECT question_id FROM question_selection
+            WHERE session_id = ? ORDER BY question_id""",
+            [session_id],
+        )
+        return [row["question_id"] for row in rows]
+
+    def clear(self, session_id: str):
+        with transaction(self.db):
+            self.db.execute(
+                "DELETE FROM question_selection WHERE session_id = ?", [session_id]
+            )
+
+
+selection_store = SQLiteSelectionStore(db)
+
+
+# Util function
+def get_selection_id(session):
+    # Every teacher session gets its own selection
+    if "selection_id" not in session:
+        session["selection_id"] = uuid.uuid4().hex
+    return session["selection_id"]
+
+
+## Answer Autosave ##
+
+
+# Util function
+def with_pending_answers(selected_masks: bytes, pending) -> bytes:
+    # The packed masks with the (slot, mask) answers that haven't been folded in yet
+    masks = bytearray(selected_masks)
+    for slot, mask in pending:
+        if 0 <= slot < len(masks):
+            masks[slot] = mask
+    return bytes(masks)
+
+
+def fold_pending_answers(conn, attempt_id=None):
+    # Moves autosaved answers into selected_masks, every attempt's or only the given one's.
+    # Runs inside a transaction, so no answer arrives between the read and the delete
+    where, params = ("WHERE attempt_id = ?", [attempt_id]) if attempt_id else ("", [])
+    pending = {}
+    for pending_attempt_id, slot, mask in conn.execute(
+        f"SELECT attempt_id, slot, mask FROM pending_answers {where}", params
+    ):
+        pending.setdefault(pending_attempt_id, []).append((slot, mask))
+    if not pending:
+        return
+    masks = dict(
+        conn.execute(
+            """SELECT id, selected_masks FROM student_quiz_result
+            WHERE id IN (SELECT value FROM json_each(?)) AND completed = 0""",
+            [json.dumps(list(pending))],
+        ).fetchall()
+    )
+    for pending_attempt_id, answers in pending.items():
+        if pending_attempt_id not in masks:
+            logger.warning(
+                "Discarded %d answers of submitted attempt %s",
+                len(answers),
+                pending_attempt_id,
+            )
+    conn.executemany(
+        "UPDATE student_quiz_result SET selected_masks = ? WHERE id = ?",
+        [
+            (
+                with_pending_answers(masks[pending_attempt_id], answers),
+                pending_attempt_id,
+            )
+            for pending_attempt_id, answers in pending.items()
+            if pending_attempt_id in masks
+        ],
+    )
+    conn.execute(f"DELETE FROM pending_answers {where}", params)
+
+
+class AnswerBuffer:
+    # Answer autosave: every click is one small upsert into pending_answers, which every
+    # worker can see, and a background thread folds them into the packed selected_masks
+    # every `interval` seconds. Submit folds its own attempt's answers before scoring
+    def __init__(self, db, interval: float = 0.5):
+        self.db = db
+        self.interval = interval
+        # Pre-created attempts opened since the last flush
+        self.pending_starts = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def mark_started(self, attempt_id: int):
+        with self.lock:
+            self.pending_starts.add(attempt_id)
+
+    def put(self, attempt_id: int, slot: int, mask: int):
+        # False when the answer was discarded
+        if mask > max_stored_mask:
+            logger.warning("Discarded answer %s of attempt %s", mask, attempt_id)
+            return False
+        with transaction(self.db):
+            saved = self.db.execute(
+                """INSERT OR REPLACE INTO pending_answers (attempt_id, slot, mask)
+                SELECT id, ?, ? FROM student_quiz_result
+                WHERE id = ? AND completed = 0""",
+                [slot, mask, attempt_id],
+            ).rowcount
+        if not saved:
+            logger.warning("Discarded answer to submitted attempt %s", attempt_id)
+        return bool(saved)
+
+    def flush(self):
+        with self.lock:
+            starts, self.pending_starts = self.pending_starts, set()
+        try:
+            with transaction(self.db):
+                self.db.conn.executemany(
+                    """UPDATE student_quiz_result
+                    SET started_at = COALESCE(started_at, CURRENT_TIMESTAMP)
+                    WHERE id = ?""",
+                    [(attempt_id,) for attempt_id in starts],
+                )
+                fold_pending_answers(self.db.conn)
+        except Exception:
+            with self.lock:
+                self.pending_starts |= starts
+            raise
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                # Retried on the next tick, the thread must outlive any single failure
+                logger.exception("Answer autosave failed")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.flush()
+
+
+answer_buffer = AnswerBuffer(db)
+app.router.on_startup.append(answer_buffer.start)
+app.router.on_shutdown.append(answer_buffer.stop)
+
+
+## Scoring ##
+
+FULL, PARTIAL, WRONG, UNANSWERED = "full", "partial", "wrong", "unanswered"
+verdict_symbols = {FULL: "🟢", PARTIAL: "🟡", WRONG: "🔴", UNANSWERED: ""}
+
+
+# Util function
+def option_masks(values) -> np.ndarray:
+    return np.fromiter(map(option_mask, values), dtype=np.uint32)
+
+
+# Util function
+def popcount(masks: np.ndarray) -> np.ndarray:
+    counts = np.zeros(masks.shape, dtype=np.uint8)
+    for bit in range(len(option_letters)):
+        counts += ((masks >> bit) & 1).astype(np.uint8)
+    return counts
+
+
+def score_masks(key_masks: np.ndarray, selected_masks: np.ndarray):
+    # Vectorized over any number of responses, one attempt or a whole class.
+    # A question is worth 1 point, split evenly between the options of its key.
+    required = popcount(key_masks)
+    matched = popcount(key_masks & selected_masks)
+    points = np.divide(
+        matched, required, out=np.zeros(len(key_masks)), where=required > 0
+    )
+    verdicts = np.select(
+        [selected_masks == 0, matched == required, matched > 0],
+        [UNANSWERED, FULL, PARTIAL],
+        default=WRONG,
+    )
+    return points, verdicts
+
+
+# Util function
+def mask_points(key_mask: int, selected_mask: int) -> float:
+    # score_masks for a single response
+    required = key_mask.bit_count()
+    return (key_mask & selected_mask).bit_count() / required if required else 0.0
+
+
+# Util function
+def score_responses(answers, selected_options):
+    return score_masks(option_masks(answers), option_masks(selected_options))
+
+
+# Util function
+def format_score(points: float, question_count: int):
+    total = round(float(points), 1)
+    return f"{int(total) if total.is_integer() else total}/{question_count}"
+
+
+# Util function
+def unpack_responses(attempts: pd.DataFrame) -> pd.DataFrame:
+    # One row per answer from the packed attempts (id, question_ids, selected_masks)
+    question_ids = [unpack_question_ids(blob) for blob in attempts["question_ids"]]
+    masks = [unpack_masks(blob) for blob in attempts["selected_masks"]]
+    return pd.DataFrame(
+        {
+            "student_quiz_id": np.repeat(
+                attempts["id"].to_numpy(dtype=np.int64), list(map(len, question_ids))
+            ),
+            "question_id": np.concatenate(
+                [np.empty(0, question_id_dtype), *question_ids]
+            ).astype(np.int64),
+            "selected_mask": np.concatenate([np.empty(0, np.uint8), *masks]).astype(
+                np.uint32
+            ),
+        }
+    )
+
+
+# Util function
+def score_unpacked(responses: pd.DataFrame, answer_keys: pd.Series):
+    # answer_keys maps question id to answers, responses to deleted questions are dropped
+    responses = responses[responses["question_id"].isin(answer_keys.index)]
+    key_masks = option_masks(answer_keys.reindex(responses["question_id"]))
+    points, verdicts = score_masks(key_masks, responses["selected_mask"].to_numpy())
+    return responses.assign(points=points, verdict=verdicts)
+
+
+## Live Progress ##
+
+
+class QuizProgress:
+    # Attempts of one quiz as the live dashboard shows them, kept up to date from events.
+    # Each attempt keeps its running points, so an answer only rescores its own slot
+    def __init__(self, quiz_id: int):
+        self.quiz_id = quiz_id
+        self.answer_keys = {}
+        self.attempts = {}
+        self.subscribers = set()
+        # Events published while the attempts are read are replayed once they are in
+        self.loaded = threading.Event()
+        self.pending_events = []
+
+    def load(self):
+        # Database reads only, the caller applies the result under the bus lock
+        answer_keys = {
+            question.id: option_mask(question.answers)
+            for question in get_quiz_snapshot(self.quiz_id).questions
+        }
+        rows = query(
+            """SELECT r.id, s.username, r.completed, r.score, r.started_at,
+                r.question_ids, r.selected_masks
+            FROM student_quiz_result r JOIN student s ON s.student_id = r.student_id
+            WHERE r.quiz_id = ?""",
+            [self.quiz_id],
+        )
+        pending = {}
+        for row in query(
+            """SELECT p.attempt_id, p.slot, p.mask FROM pending_answers p
+            JOIN student_quiz_result r ON r.id = p.attempt_id WHERE r.quiz_id = ?""",
+            [self.quiz_id],
+        ):
+            pending.setdefault(row["attempt_id"], []).append((row["slot"], row["mask"]))
+        return answer_keys, rows, pending
+
+    def finish_loading(self, loaded):
+        if loaded:
+            self.answer_keys, rows, pending = loaded
+            for row in rows:
+                masks = with_pending_answers(
+                    row["selected_masks"], pending.get(row["id"], [])
+                )
+                self.start(
+                    row["id"],
+                    row["username"],
+                    unpack_question_ids(row["question_ids"]),
+                    unpack_masks(masks),
+                    started=row["started_at"] is not None,
+                )
+                if row["completed"]:
+                    self.submit(row["id"], row["score"])
+        for event, attempt_id, args in self.pending_events:
+            getattr(self, event)(attempt_id, *args)
+        self.pending_events.clear()
+        self.loaded.set()
+
+    def apply(self, event: str, attempt_id: int, *args):
+        if self.loaded.is_set():
+            getattr(self, event)(attempt_id, *args)
+        else:
+            self.pending_events.append((event, attempt_id, args))
+
+    def start(
+        self, attempt_id: int, username: str, question_ids, masks=None, started=True
+    ):
+        if attempt_id in self.attempts:
+            # A pre-created attempt that the student has now opened
+            self.attempts[attempt_id]["started"] |= started
+            return
+        keys = np.array(
+            [self.answer_keys.get(int(question_id), 0) for question_id in question_ids],
+            dtype=np.uint32,
+        )
+        masks = np.zeros(len(keys), np.uint32) if masks is None else masks
+        points, _ = score_masks(keys, masks.astype(np.uint32))
+        self.attempts[attempt_id] = {
+            "username": username,
+            "keys": keys.tolist(),
+            "masks": masks.tolist(),
+            "points": points.tolist(),
+            "total_points": float(points.sum()),
+            "answered": int(np.count_nonzero(masks)),
+            "started": started,
+            "score": None,
+        }
+
+    def answer(self, attempt_id: int, slot: int, mask: int):
+        attempt = self.attempts.get(attempt_id)
+        if not attempt or not 0 <= slot < len(attempt["masks"]):
+            return
+        points = mask_points(attempt["keys"][slot], mask)
+        attempt["total_points"] += points - attempt["points"][slot]
+        attempt["answered"] += bool(mask) - bool(attempt["masks"][slot])
+        attempt["points"][slot], attempt["masks"][slot] = points, mask
+
+    def submit(self, attempt_id: int, score: str):
+        if attempt_id in self.attempts:
+            self.attempts[attempt_id]["score"] = score
+
+    def row_values(self, attempt_id: int):
+        attempt = self.attempts[attempt_id]
+        total = len(attempt["masks"])
+        return (
+            attempt["username"],
+            f"{attempt["answered"]}/{total}",
+            (
+                "Submitted"
+                if attempt["score"]
+                else "In progress" if attempt["started"] else "Not started"
+            ),
+            attempt["score"] or format_score(attempt["total_points"], total),
+        )
+
+    def summary_values(self):
+        started = sum(1 for attempt in self.attempts.values() if attempt["started"])
+        submitted = sum(1 for attempt in self.attempts.values() if attempt["score"])
+        return started, submitted, len(self.attempts) - started
+
+
+def render_progress_row(attempt_id: int, values: tuple):
+    return Tr(*map(Td, values), id=f"attempt-{attempt_id}")
+
+
+def render_progress_summary(started: int, submitted: int, not_started: int):
+    return Div(
+        Strong(
+            f"Started: {started} | Submitted: {submitted} | Not started: {not_started}"
+        ),
+        id="progress-summary",
+        hx_swap_oob="true",
+    )
+
+
+class ProgressBus:
+    # In-process event bus: the answer, start and submit handlers publish attempt changes,
+    # and every dashboard stream of that quiz is told which attempts changed.
+    # The lock only guards the in-memory state, reads and rendering happen outside it
+    def __init__(self):
+        self.quizzes = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, quiz_id: int, loop, queue):
+        with self.lock:
+            progress = self.quizzes.get(quiz_id)
+            first = progress is None
+            if first:
+                progress = self.quizzes[quiz_id] = QuizProgress(quiz_id)
+            progress.subscribers.add((loop, queue))
+        if first:
+            loaded = None
+            try:
+                loaded = progress.load()
+            finally:
+                # Without the attempts on failure, so later subscribers don't wait forever
+                with self.lock:
+                    progress.finish_loading(loaded)
+        progress.loaded.wait()
+
+    def unsubscribe(self, quiz_id: int, loop, queue):
+        with self.lock:
+            progress = self.quizzes.get(quiz_id)
+            if progress is None:
+                return
+            progress.subscribers.discard((loop, queue))
+            # Nobody is watching anymore, the next dashboard reloads from the database
+            if not progress.subscribers:
+                del self.quizzes[quiz_id]
+
+    def publish(self, quiz_id: int, event: str, attempt_id: int, *args):
+        with self.lock:
+            progress = self.quizzes.get(quiz_id)
+            if progress is None:
+                return
+            progress.apply(event, attempt_id, *args)
+            subscribers = list(progress.subscribers)
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, attempt_id)
+
+    def render(self, quiz_id: int, attempt_ids=None):
+        # Every attempt when attempt_ids is None, otherwise only the given ones
+        with self.lock:
+            progress = self.quizzes[quiz_id]
+            if attempt_ids is None:
+                attempt_ids = sorted(progress.attempts)
+            values = {
+                attempt_id: progress.row_values(attempt_id)
+                for attempt_id in attempt_ids
+                if attempt_id in progress.attempts
+            }
+            summary = progress.summary_values()
+        rows = {
+            attempt_id: render_progress_row(attempt_id, row)
+            for attempt_id, row in values.items()
+        }
+        return rows, render_progress_summary(*summary)
+
+
+progress_bus = ProgressBus()
+
+
+## Item Analysis ##
+
+item_stat_columns = [
+    "attempts",
+    "full_credit",
+    "partial_credit",
+    "unanswered",
+    # Sums over attempts of the question's points x and the attempt's total y,
+    # enough to derive the item-total correlation without revisiting the responses
+    "sum_points",
+    "sum_points_sq",
+    "sum_totals",
+    "sum_totals_sq",
+    "sum_points_totals",
+]
+
+
+# Util function
+def quiz_answer_keys(quiz_id: int) -> pd.Series:
+    questions = get_quiz_snapshot(quiz_id).questions
+    return pd.Series(
+        [question.answers for question in questions],
+        index=[question.id for question in questions],
+        dtype=object,
+    )
+
+
+def item_counters(scored: pd.DataFrame):
+    # Counters of a set of scored responses (see score_unpacked), which simply add up.
+    # Plain numpy, as this runs on every submit
+    question_ids, questions = np.unique(scored["question_id"], return_inverse=True)
+    _, attempts = np.unique(scored["student_quiz_id"], return_inverse=True)
+    points = scored["points"].to_numpy(dtype=float)
+    totals = np.bincount(attempts, weights=points)[attempts]
+    verdicts = scored["verdict"].to_numpy()
+    values = [
+        np.ones(len(scored)),
+        verdicts == FULL,
+        verdicts == PARTIAL,
+        verdicts == UNANSWERED,
+        points,
+        points**2,
+        totals,
+        totals**2,
+        points * totals,
+    ]
+    sums = [
+        np.bincount(questions, weights=value, minlength=len(question_ids))
+        for value in values
+    ]
+    question_rows = [
+        (int(question_id), *(int(total) for total in row[:4]), *map(float, row[4:]))
+        for question_id, *row in zip(question_ids, *sums)
+    ]
+    # Selections of every option letter that occurs in the masks
+    masks = scored["selected_mask"].to_numpy(dtype=np.int64)
+    option_rows = []
+    for bit, letter in enumerate(
+        option_letters[: int(masks.max(initial=0)).bit_length()]
+    ):
+        selected = np.bincount(
+            questions, weights=(masks >> bit) & 1, minlength=len(question_ids)
+        )
+        option_rows += [
+            (int(question_id), letter, int(count))
+            for question_id, count in zip(question_ids, selected)
+            if count
+        ]
+    return question_rows, option_rows
+
+
+def add_item_counters(conn, quiz_id: int, counters):
+    question_rows, option_rows = counters
+    conn.executemany(
+        f"""INSERT INTO item_stats (quiz_id, question_id, {", ".join(item_stat_columns)})
+        VALUES (?, ?, {", ".join("?" * len(item_stat_columns))})
+        ON CONFLICT (quiz_id, question_id) DO UPDATE SET
+        {", ".join(f"{column} = {column} + excluded.{column}" for column in item_stat_columns)}""",
+        [(quiz_id, *row) for row in question_rows],
+    )
+    conn.executemany(
+        """INSERT INTO item_option_stats (quiz_id, question_id, option, selected)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (quiz_id, question_id, option) DO UPDATE SET
+        selected = selected + excluded.selected""",
+        [(quiz_id, *row) for row in option_rows],
+    )
+
+
+def rebuild_item_stats(conn, quiz_id: int, batch_size: int = 500):
+    # One transaction, so submits wait instead of adding to counters that are being replaced
+    answer_keys = quiz_answer_keys(quiz_id)
+    with transaction(conn):
+        conn.execute("DELETE FROM item_stats WHERE quiz_id = ?", [quiz_id])
+        conn.execute("DELETE FROM item_option_stats WHERE quiz_id = ?", [quiz_id])
+        attempts = pd.read_sql_query(
+            """SELECT id, question_ids, selected_masks FROM student_quiz_result
+            WHERE quiz_id = ? AND completed = 1""",
+            conn,
+            params=[quiz_id],
+            chunksize=batch_size,
+        )
+        for batch in attempts:
+            scored = score_unpacked(unpack_responses(batch), answer_keys)
+            add_item_counters(conn, quiz_id, item_counters(scored))
+
+
+def rebuild_item_stats_job(conn, job_id: str, quiz_ids: list, next_url: str):
+    update_job(conn, job_id, total=len(quiz_ids))
+    for processed, quiz_id in enumerate(quiz_ids, start=1):
+        rebuild_item_stats(conn, quiz_id)
+        update_job(conn, job_id, processed=processed)
+    update_job(
+        conn,
+        job_id,
+        message=f"Rebuilt the statistics of {len(quiz_ids)} quizzes",
+        next_url=next_url,
+    )
+
+
+# Util function
+def correlation(n, sum_x, sum_x2, sum_y, sum_y2, sum_xy):
+    spread = (n * sum_x2 - sum_x**2) * (n * sum_y2 - sum_y**2)
+    return (n * sum_xy - sum_x * sum_y) / spread**0.5 if spread > 0 else None
+
+
+def get_item_analysis(quiz_id: int):
+    # Reads only the counters, so the cost doesn't grow with the number of attempts
+    with read_db() as reader:
+        stats = reader.q(
+            """SELECT s.*, q.question, q.answers FROM item_stats s
+            LEFT JOIN questions q ON q.id = s.question_id
+            WHERE s.quiz_id = ? ORDER BY s.question_id""",
+            [quiz_id],
+        )
+        options = reader.q(
+            """SELECT question_id, option, selected FROM item_option_stats
+            WHERE quiz_id = ? ORDER BY option""",
+            [quiz_id],
+        )
+    distribution = {}
+    for row in options:
+        distribution.setdefault(row["question_id"], {})[row["option"]] = row["selected"]
+    items = []
+    for row in stats:
+        n = row["attempts"]
+        items.append(
+            {
+                "question_id": row["question_id"],
+                "question": row["question"],
+                "answers": row["answers"],
+                "attempts": n,
+                "difficulty": row["full_credit"] / n,
+                "partial_rate": row["partial_credit"] / n,
+                "unanswered_rate": row["unanswered"] / n,
+                "mean_points": row["sum_points"] / n,
+                "options": {
+                    option: selected / n
+                    for option, selected in distribution.get(
+                        row["question_id"], {}
+                    ).items()
+                },
+                # Item-rest correlation: the question against the rest of the attempt
+                "discrimination": correlation(
+                    n,
+                    row["sum_points"],
+                    row["sum_points_sq"],
+                    row["sum_totals"] - row["sum_points"],
+                    row["sum_totals_sq"]
+                    - 2 * row["sum_points_totals"]
+                    + row["sum_points_sq"],
+                    row["sum_points_totals"] - row["sum_points_sq"],
+                ),
+            }
+        )
+    return items
 
-# To make the username unique
-students.create_index(["username"], unique=True, if_not_exists=True)
 
 column_names = ["Select", "Question", "A", "B", "C", "D", "Answer", "Tag"]
 
@@ -149,6 +1704,8 @@ def get():
         "Quiz",
         A("Upload Excel", href="/upload"),
         " | ",
+        A("Import Roster", href="/roster"),
+        " | ",
         A("All Questions", href="/questions"),
         " | ",
         A("All Quizzes", href="/all_quizzes"),
@@ -166,65 +1723,506 @@ def get():
             accept=".xlsx",
             required="true",
         ),
+        Select(
+            Option("Add new and update changed questions", value="incremental"),
+            # Replacing the bank leaves existing quizzes pointing to other questions
+            Option("Replace all questions", value="replace"),
+            name="mode",
+        ),
         Button("Upload"),
     )
-    form = Form(
-        group,
-        hx_post="/upload",
-        target_id="main",
-        enctype="multipart/form-data",  # multipart/form-data is required for file upload
+    form = Form(
+        group,
+        hx_post="/upload",
+        target_id="main",
+        enctype="multipart/form-data",  # multipart/form-data is required for file upload
+    )
+    return Title("LMS"), Container(form, Div(id="main"))
+
+
+# Util function
+def standardize_column(column_name):
+    cleaned_column = column_name.strip().lower()
+    # Replace consecutive spaces with a single underscore
+    return re.sub(r"\s+", "_", cleaned_column)
+
+
+# Util function
+def normalize_cell(value):
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    if isinstance(value, bool):
+        # Excel shows booleans as TRUE/FALSE
+        return str(value).upper()
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+# Util function
+async def spool_upload(file: UploadFile, suffix: str):
+    # Copy the upload to disk in chunks instead of reading it into memory
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as spool:
+        while chunk := await file.read(1024 * 1024):
+            await run_in_threadpool(spool.write, chunk)
+    return spool.name
+
+
+# Util function
+def iter_sheet_rows(header: list, rows, required: set):
+    # The header is checked once up front, a blank line yields an empty row
+    missing = required - set(header)
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(sorted(missing))}")
+    for row in rows:
+        yield dict(zip(header, map(normalize_cell, row)))
+
+
+# Util function
+def iter_excel_rows(path: str, required: set):
+    # Read-only workbooks stream rows from the file instead of loading the whole sheet
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [standardize_column(str(col or "")) for col in next(rows, ())]
+        yield from iter_sheet_rows(header, rows, required)
+    finally:
+        workbook.close()
+
+
+# Util function
+def iter_csv_rows(path: str, required: set):
+    # Same rows as iter_excel_rows, utf-8-sig also reads the byte order mark Excel writes
+    with open(path, newline="", encoding="utf-8-sig") as file:
+        rows = csv.reader(file)
+        header = [standardize_column(col) for col in next(rows, [])]
+        yield from iter_sheet_rows(header, rows, required)
+
+
+# Util function
+def validate_question_row(row: dict):
+    # Rows that are empty or have no question are skipped
+    if not row.get("question"):
+        return None
+    question = {column: row.get(column) for column in question_columns}
+    # If there is no answer then the default answer is 'A'
+    question["answers"] = (question["answers"] or "A").upper().replace(" ", "")
+    return question
+
+
+# A staged row i is the bank question q with the same stem and options, so questions
+# that only share their text stay apart
+same_question = """q.question = i.question AND q.a IS i.a AND q.b IS i.b
+    AND q.c IS i.c AND q.d IS i.d"""
+
+
+def merge_imported_questions(conn, replace: bool):
+    # Set-based merge of the staged rows, matched to the bank by stem and options
+    conn.execute(
+        "UPDATE content_versions SET version = version + 1 WHERE name = 'questions'"
+    )
+    merged = 0
+    if replace:
+        conn.execute("DELETE FROM questions")
+    else:
+        # The last row wins when the workbook repeats a question
+        merged = conn.execute(
+            """DELETE FROM import_questions WHERE rowid NOT IN (
+                SELECT MAX(rowid) FROM import_questions GROUP BY question, a, b, c, d
+            )"""
+        ).rowcount
+    # Attempts that answered these questions have to be regraded
+    rekeyed = [
+        row[0]
+        for row in conn.execute(
+            f"""SELECT q.id FROM questions q
+            JOIN import_questions i ON {same_question}
+            WHERE q.answers IS NOT i.answers"""
+        )
+    ]
+    unchanged = conn.execute(
+        f"""SELECT COUNT(*) FROM import_questions i WHERE EXISTS (
+            SELECT 1 FROM questions q
+            WHERE {same_question} AND q.content_hash = i.content_hash
+        )"""
+    ).fetchone()[0]
+    updated = conn.execute(
+        f"""UPDATE questions AS q SET answers = i.answers, tag = i.tag,
+            content_hash = i.content_hash
+        FROM import_questions i
+        WHERE {same_question} AND q.content_hash IS NOT i.content_hash"""
+    ).rowcount
+    columns = ", ".join([*question_columns, "content_hash"])
+    inserted = conn.execute(
+        f"""INSERT INTO questions ({columns})
+        SELECT {columns} FROM import_questions i
+        WHERE NOT EXISTS (SELECT 1 FROM questions q WHERE {same_question})
+        ORDER BY i.rowid"""
+    ).rowcount
+    return inserted, updated, unchanged, merged, rekeyed
+
+
+def import_questions(
+    conn, job_id: str, path: str, replace: bool, chunk_size: int = 1000
+):
+    try:
+        workbook = openpyxl.load_workbook(path, read_only=True)
+        update_job(conn, job_id, total=max((workbook.active.max_row or 1) - 1, 0))
+        workbook.close()
+
+        counts = {"processed": 0, "skipped": 0}
+
+        def valid_rows():
+            for row in iter_excel_rows(path, {"question", "a", "b"}):
+                counts["processed"] += 1
+                question = validate_question_row(row)
+                if question is None:
+                    counts["skipped"] += 1
+                    continue
+                yield [
+                    *(question[column] for column in question_columns),
+                    question_hash(question),
+                ]
+
+        # Rows are staged in a temp table first so the bank is merged in one transaction
+        columns = [*question_columns, "content_hash"]
+        conn.execute(f"CREATE TEMP TABLE import_questions ({", ".join(columns)})")
+        insert_sql = "INSERT INTO import_questions VALUES ({})".format(
+            ", ".join("?" * len(columns))
+        )
+        for chunk in itertools.batched(valid_rows(), chunk_size):
+            with transaction(conn):
+                conn.executemany(insert_sql, chunk)
+            update_job(conn, job_id, processed=counts["processed"])
+        with transaction(conn):
+            inserted, updated, unchanged, merged, rekeyed = merge_imported_questions(
+                conn, replace
+            )
+    finally:
+        os.remove(path)
+        # The new bank version already keys new entries, this only frees the old ones
+        quiz_cache.clear()
+        page_cache.clear()
+    next_url = "/questions"
+    if rekeyed:
+        # Show the regrade progress once the import is done
+        regrade_id = start_job("Regrade", regrade_attempts, rekeyed, next_url)
+        next_url = f"/jobs/{regrade_id}"
+    update_job(
+        conn,
+        job_id,
+        processed=counts["processed"],
+        message=f"Successfully imported: {inserted} added, {updated} updated,"
+        f" {unchanged} unchanged, {merged} repeated rows merged"
+        f" ({counts["skipped"]} empty rows skipped)",
+        next_url=next_url,
+    )
+
+
+@route("/upload")
+async def post(file: UploadFile, mode: str = "incremental"):
+    if not file.filename.endswith("xlsx"):
+        return "Invalid file type! - Only .xlsx files are allowed"
+    path = await spool_upload(file, suffix=".xlsx")
+    # The import runs in a background thread and the page polls its progress
+    job_id = await run_in_threadpool(
+        start_job, "Upload", import_questions, path, mode == "replace"
+    )
+    return render_job_progress(job_id)
+
+
+@route("/roster")
+def get():
+    group = Group(
+        Input(
+            type="file",
+            name="file",
+            accept=".xlsx,.csv",
+            required="true",
+        ),
+        Select(
+            Option("Don't create attempts", value="0"),
+            *[
+                Option(f"Create attempts for {quiz['quiz_name']}", value=quiz["id"])
+                for quiz in query("SELECT id, quiz_name FROM quizzes ORDER BY id")
+            ],
+            name="quiz_id",
+        ),
+        Button("Import"),
+    )
+    form = Form(
+        group,
+        hx_post="/roster",
+        target_id="main",
+        enctype="multipart/form-data",
+    )
+    # The file needs a Username column, and optionally a Group or Class column
+    return Title("Roster"), Container(
+        P("Columns: Username, and optionally Group"), form, Div(id="main")
+    )
+
+
+# Util function
+def validate_roster_row(row: dict):
+    # Rows that are empty or have no username are skipped
+    if not row.get("username"):
+        return None
+    return row["username"], row.get("group", row.get("class"))
+
+
+def import_roster(conn, job_id: str, path: str, quiz_id: int, chunk_size: int = 1000):
+    try:
+        iter_rows = iter_csv_rows if path.endswith(".csv") else iter_excel_rows
+        rows = iter_rows(path, {"username"})
+        counts = {"processed": 0, "skipped": 0}
+
+        def valid_rows():
+            for row in rows:
+                counts["processed"] += 1
+                student = validate_roster_row(row)
+                if student is None:
+                    counts["skipped"] += 1
+                    continue
+                yield student
+
+        # Staged like the question import, so the roster is merged in one transaction
+        conn.execute("CREATE TEMP TABLE import_students (username, student_group)")
+        for chunk in itertools.batched(valid_rows(), chunk_size):
+            with transaction(conn):
+                conn.executemany("INSERT INTO import_students VALUES (?, ?)", chunk)
+            update_job(conn, job_id, processed=counts["processed"])
+        with transaction(conn):
+            # The last row wins when the file repeats a username
+            conn.execute(
+                """DELETE FROM import_students WHERE rowid NOT IN (
+                    SELECT MAX(rowid) FROM import_students GROUP BY username
+                )"""
+            )
+            existing = conn.execute(
+                """SELECT COUNT(*) FROM import_students i
+                WHERE EXISTS (SELECT 1 FROM student s WHERE s.username = i.username)"""
+            ).fetchone()[0]
+            # A row without a group keeps the group the student already has
+            # WHERE true tells SQLite that ON CONFLICT belongs to the INSERT
+            imported = conn.execute(
+                """INSERT INTO student (username, student_group)
+                SELECT username, student_group FROM import_students WHERE true
+                ORDER BY rowid
+                ON CONFLICT (username) DO UPDATE SET
+                student_group = COALESCE(excluded.student_group, student_group)"""
+            ).rowcount
+            created = 0
+            if quiz_id:
+                # The attempts exam morning would otherwise create one login at a time
+                question_ids = [
+                    row[0]
+                    for row in conn.execute(
+                        """SELECT question_id FROM quiz_questions
+                        WHERE quiz_id = ? ORDER BY question_id""",
+                        [quiz_id],
+                    )
+                ]
+                created = conn.execute(
+                    """INSERT INTO student_quiz_result
+                        (student_id, quiz_id, completed, question_ids, selected_masks)
+                    SELECT s.student_id, ?, 0, ?, zeroblob(?)
+                    FROM student s JOIN import_students i ON i.username = s.username
+                    WHERE true
+                    ON CONFLICT (student_id, quiz_id) DO NOTHING""",
+                    [quiz_id, pack_question_ids(question_ids), len(question_ids)],
+                ).rowcount
+    finally:
+        os.remove(path)
+    update_job(
+        conn,
+        job_id,
+        processed=counts["processed"],
+        message=f"Successfully imported: {imported - existing} added,"
+        f" {existing} updated, {created} attempts created"
+        f" ({counts["skipped"]} empty rows skipped)",
+        next_url="/all_quizzes",
+    )
+
+
+@route("/roster")
+async def post(file: UploadFile, quiz_id: int = 0):
+    suffix = Path(file.filename).suffix.lower()
+    if suffix not in (".xlsx", ".csv"):
+        return "Invalid file type! - Only .xlsx and .csv files are allowed"
+    path = await spool_upload(file, suffix=suffix)
+    job_id = await run_in_threadpool(
+        start_job, "Roster import", import_roster, path, quiz_id
+    )
+    return render_job_progress(job_id)
+
+
+questions_page_size = 50
+
+
+# Util function
+def search_expression(search: str):
+    # Every word has to match, the last one as a prefix so results follow the typing
+    terms = ['"' + term.replace('"', '""') + '"' for term in search.split()]
+    if terms:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+# Util function
+def questions_filter(search: str = "", tag: str = ""):
+    where, where_args = ["1"], []
+    if search_expression(search):
+        where.append(
+            "id IN (SELECT rowid FROM question_search WHERE question_search MATCH ?)"
+        )
+        where_args.append(search_expression(search))
+    if tag and tag != "*":
+        where.append("tag = ?")
+        where_args.append(tag)
+    return " AND ".join(where), where_args
+
+
+# Util function
+def get_questions_page(after: int = 0, search: str = "", tag: str = "", offset=0):
+    if search_expression(search):
+        # Best matches first, so the page is an offset into the ranking
+        where, where_args = questions_filter(tag=tag)
+        rows = query(
+            f"""SELECT q.* FROM question_search s JOIN questions q ON q.id = s.rowid
+            WHERE question_search MATCH ?
+                AND q.id IN (SELECT id FROM questions WHERE {where})
+            ORDER BY s.rank, q.id LIMIT ? OFFSET ?""",
+            [search_expression(search), *where_args, questions_page_size, offset],
+        )
+    else:
+        # Keyset pagination, the page starts right after the last id already shown
+        where, where_args = questions_filter(tag=tag)
+        rows = query(
+            f"SELECT * FROM questions WHERE id > ? AND {where} ORDER BY id LIMIT ?",
+            [after, *where_args, questions_page_size],
+        )
+    return [Questions(**row) for row in rows]
+
+
+def render_questions_page(
+    selection_id: str, after: int = 0, search: str = "", tag: str = "", offset=0
+):
+    page = get_questions_page(after, search, tag, offset)
+    selected = selection_store.selected_among(
+        selection_id, [question.id for question in page]
+    )
+    rows = [render_row(question, selected) for question in page[:-1]]
+    if page:
+        next_page_url = None
+        if len(page) == questions_page_size:
+            params = {"after": page[-1].id, "search": search, "tag": tag}
+            if search_expression(search):
+                params = {"offset": offset + len(page), "search": search, "tag": tag}
+            next_page_url = f"/questions/rows?{urlencode(params)}"
+        rows.append(render_row(page[-1], selected, next_page_url))
+    return rows
+
+
+def render_questions_table(selection_id: str, search: str = "", tag: str = ""):
+    return Table(
+        Thead(Tr(map(Th, column_names)), cls="freeze-header"),
+        Tbody(*render_questions_page(selection_id, search=search, tag=tag)),
+        cls="striped",
     )
-    return Title("LMS"), Container(form, Div(id="main"))
 
 
 # Util function
-def standardize_column(column_name):
-    cleaned_column = column_name.strip().lower()
-    # Replace consecutive spaces with a single underscore
-    return re.sub(r"\s+", "_", cleaned_column)
+def get_tag_facets(search: str = ""):
+    # Number of questions per tag among the ones matching the search
+    where, where_args = questions_filter(search)
+    return query(
+        f"""SELECT tag, COUNT(*) AS count FROM questions WHERE {where}
+        GROUP BY tag ORDER BY tag""",
+        where_args,
+    )
 
 
-# Util function
-def convert_binary_to_df(file_content):
-    # Create a BytesIO object to read it as excel
-    excel_data = BytesIO(file_content)
-    df = pd.read_excel(excel_data, dtype=object)
-    df.columns = [standardize_column(col) for col in df.columns]
-    # If there is no answer then the default answer is 'A'
-    df.answers = df.answers.fillna("A")
-    return df
+def render_tag_facets(search: str = "", tag: str = "", oob: bool = False):
+    facets = get_tag_facets(search)
+    total = sum(facet["count"] for facet in facets)
+    return Select(
+        # Empty attribute values aren't rendered, so "*" stands for every tag
+        Option(f"All tags ({total})", value="*"),
+        *[
+            Option(
+                f"{facet["tag"]} ({facet["count"]})",
+                value=facet["tag"],
+                selected=facet["tag"] == tag,
+            )
+            for facet in facets
+            if facet["tag"]
+        ],
+        name="tag",
+        id="tag-facets",
+        hx_swap_oob="true" if oob else None,
+    )
 
 
-@route("/upload")
-async def post(file: UploadFile):
-    if not file.filename.endswith("xlsx"):
-        return "Invalid file type! - Only .xlsx files are allowed"
-    file_content = await file.read()
-    df = convert_binary_to_df(file_content)
-    # To easily insert all the data into db we need to convert it to list of dict
-    data = df.to_dict(
-        orient="records"  # This will give each row as a dict value with column name as key
-    )
-    # For testing purposes we are deleting all the data from db before inserting new data
-    questions.insert_all(data, truncate=True)
-    return (
-        P("Successfully added"),
-        # It will redirect to '/questions' after 1 sec
-        Meta(http_equiv="refresh", content="1; url=/questions"),
+def render_questions_results(selection_id: str, search: str = "", tag: str = ""):
+    # The table plus the facet counts for the new search, swapped in next to the box
+    return render_questions_table(selection_id, search, tag), render_tag_facets(
+        search, tag, oob=True
     )
 
 
 @route("/questions")
-def get():
-    table = Table(
-        Thead(Tr(map(Th, column_names)), cls="freeze-header"),
-        Tbody(map(render_row, questions())),
-        cls="striped",
+def get(session):
+    filters = Form(
+        Group(
+            Input(type="search", name="search", placeholder="Search questions"),
+            render_tag_facets(),
+        ),
+        Group(
+            Button("Select all matching", hx_post="/select_questions/select"),
+            Button(
+                "Deselect all matching",
+                hx_post="/select_questions/deselect",
+                cls="secondary",
+            ),
+        ),
+        hx_get="/questions/results",
+        hx_trigger="input changed delay:300ms, change",
+        target_id="question-results",
+    )
+    table = Div(
+        render_questions_table(get_selection_id(session)), id="question-results"
     )
     export_button = A(Button("Export"), href="/download")
+    export_csv_button = A(Button("Export CSV"), href="/download?format=csv")
     preview_button = A(Button("Preview"), href="/preview_questions")
-    buttons = Div(export_button, " ", preview_button, cls="freeze-btn")
-    return Container(table), buttons
+    buttons = Div(
+        export_button, " ", export_csv_button, " ", preview_button, cls="freeze-btn"
+    )
+    return Container(filters, table), buttons
+
+
+@route("/questions/results")
+def get(session, search: str = "", tag: str = ""):
+    return render_questions_results(get_selection_id(session), search, tag)
+
+
+@route("/questions/rows")
+def get(session, after: int = 0, search: str = "", tag: str = "", offset: int = 0):
+    return tuple(
+        render_questions_page(get_selection_id(session), after, search, tag, offset)
+    )
+
+
+@route("/select_questions/{action}")
+def post(session, action: str, search: str = "", tag: str = ""):
+    # Bulk (de)select every question matching the current filters
+    selection_id = get_selection_id(session)
+    where, where_args = questions_filter(search, tag)
+    if action == "select":
+        selection_store.select_where(selection_id, where, where_args)
+    else:
+        selection_store.deselect_where(selection_id, where, where_args)
+    return render_questions_results(selection_id, search, tag)
 
 
 def render_question(questions):
@@ -234,14 +2232,13 @@ def render_question(questions):
 # Util function
 def get_questions_by_question_ids(questions_id: list):
     if not questions_id:
-        # vars is used to convert object to dict
-        # because the else block returns list of dicts hence we standardized
-        selected_quiz_questions = map(vars, questions())
-    else:
-        # Created a query to get all the selected questions like, 'id IN (1, 2)'
-        query = "id IN ({}) ".format(", ".join(map(str, questions_id)))
-        selected_quiz_questions = list(questions.rows_where(where=query))
-    return selected_quiz_questions
+        return query("SELECT * FROM questions ORDER BY id")
+    # The ids go in as one JSON parameter, however many questions are selected
+    return query(
+        """SELECT * FROM questions
+        WHERE id IN (SELECT value FROM json_each(?)) ORDER BY id""",
+        [json.dumps(questions_id)],
+    )
 
 
 def get_preview_questions(questions_id: list):
@@ -259,7 +2256,7 @@ def get_preview_questions(questions_id: list):
 
 
 @route("/preview_questions")
-def get():
+def get(session):
     quiz_name_input = Input(
         placeholder="Enter Quiz Name", id="quiz_name", required=True
     )
@@ -270,20 +2267,26 @@ def get():
     )
     back_to_select = A(Button("Back to select"), href="/questions")
     card = Card(
-        get_preview_questions(selected_questions_id), header=form, footer=back_to_select
+        get_preview_questions(selection_store.selected(get_selection_id(session))),
+        header=form,
+        footer=back_to_select,
     )
     return Titled("Create Quiz", card)
 
 
 # Util function
 def get_question_ids_by_quiz_id(quiz_id: int):
-    query = f"quiz_id = {quiz_id}"
-    return [row["question_id"] for row in quiz_questions.rows_where(where=query)]
+    return [
+        row["question_id"]
+        for row in query(
+            "SELECT question_id FROM quiz_questions WHERE quiz_id = ? ORDER BY id",
+            [quiz_id],
+        )
+    ]
 
 
-@route("/preview_quiz/{quiz_id}")
-def get(quiz_id: int):
-    quiz_name = quizzes.get(quiz_id).quiz_name
+def render_quiz_preview(quiz_id: int):
+    quiz_name = get_quiz_snapshot(quiz_id).quiz_name
     quiz_questions_id = get_question_ids_by_quiz_id(quiz_id)
     preview_questions = get_preview_questions(quiz_questions_id)
     back_button = A(Button("Back"), href="/all_quizzes")
@@ -294,15 +2297,30 @@ def get(quiz_id: int):
     return Title("Quiz Preview"), Container("Quiz Name", H3(quiz_name), card)
 
 
+@route("/preview_quiz/{quiz_id}")
+def get(quiz_id: int, req):
+    return render_cached_page(
+        req, ("preview", quiz_id, bank_version()), lambda: render_quiz_preview(quiz_id)
+    )
+
+
 @route("/create_quiz")
-def post(quiz_name: Quizzes):  # type:ignore
-    global selected_questions_id
-    quiz_data = quizzes.insert(quiz_name)
-    for question_id in selected_questions_id:
-        quiz_questions.insert(quiz_id=quiz_data.id, question_id=question_id)
+def post(quiz_name: Quizzes, session):  # type:ignore
+    selection_id = get_selection_id(session)
+    question_ids = selection_store.selected(selection_id)
+    # The quiz and all its question mappings are written in a single transaction
+    with transaction(db):
+        quiz_id = db.execute(
+            "INSERT INTO quizzes (quiz_name) VALUES (?) RETURNING id",
+            [quiz_name.quiz_name],
+        ).fetchone()[0]
+        db.conn.executemany(
+            "INSERT OR IGNORE INTO quiz_questions (quiz_id, question_id) VALUES (?, ?)",
+            [(quiz_id, question_id) for question_id in question_ids],
+        )
 
     # Clear the selected questions after creating the quiz
-    selected_questions_id = []
+    selection_store.clear(selection_id)
     return (
         P("Successfully Created Quiz"),
         # It will redirect to '/questions' after 1 sec
@@ -310,76 +2328,73 @@ def post(quiz_name: Quizzes):  # type:ignore
     )
 
 
-def render_quiz_details_for_teacher(quiz_data):
-    question_count = len(get_question_ids_by_quiz_id(quiz_data.id))
-    return Tr(
-        Td(quiz_data.quiz_name),
-        Td(question_count),
-        Td(A("Show", href=f"/preview_quiz/{quiz_data.id}")),
-        Td(A("Result", href=f"/quiz_result/{quiz_data.id}")),
+# Util function
+def get_teacher_quiz_rows():
+    # Every quiz with its question count in one query
+    return query(
+        """SELECT z.id, z.quiz_name, COUNT(qq.question_id) AS question_count
+        FROM quizzes z LEFT JOIN quiz_questions qq ON qq.quiz_id = z.id
+        GROUP BY z.id ORDER BY z.id"""
     )
 
 
-def render_evaluated_answer(data):
-    correct_answer = questions.get(data["question_id"]).answers
-    student_answer = data["selected_option"]
-    answers = [correct_option in student_answer for correct_option in correct_answer]
-    if student_answer == "":
-        return ""
-    elif all(answers):
-        return "🟢"
-    elif any(answers):
-        return "🟡"
-    else:
-        return "🔴"
+def render_quiz_details_for_teacher(quiz_data: dict):
+    quiz_id = quiz_data["id"]
+    return Tr(
+        Td(quiz_data["quiz_name"]),
+        Td(quiz_data["question_count"]),
+        Td(A("Show", href=f"/preview_quiz/{quiz_id}")),
+        Td(A("Result", href=f"/quiz_result/{quiz_id}")),
+        Td(A("Live", href=f"/quiz_progress/{quiz_id}")),
+        Td(A("Analytics", href=f"/quiz_analytics/{quiz_id}")),
+    )
 
 
+# Util function
 def render_quiz_result_table(quiz_id):
-    question_ids = get_question_ids_by_quiz_id(quiz_id)
-    filtered_questions = get_questions_by_question_ids(question_ids)
-    table_data = {}
-    table_data["Questions"] = [question["question"] for question in filtered_questions]
-    table_data["Answers"] = [question["answers"] for question in filtered_questions]
-    # display score data row at the end
-    table_data["Questions"].append("Total Score")
-    table_data["Answers"].append("")
-
-    # Getting only the studetns who have completed the quiz
-    quiz_details = list(
-        student_quiz_result.rows_where(where=f"quiz_id = {quiz_id} AND completed = 1")
+    with read_db() as reader:
+        quiz_questions_df = pd.read_sql_query(
+            """SELECT q.id, q.question, q.answers FROM quiz_questions qq
+            JOIN questions q ON q.id = qq.question_id
+            WHERE qq.quiz_id = ? ORDER BY q.id""",
+            reader.conn,
+            params=[quiz_id],
+        )
+        # Getting only the students who have completed the quiz
+        attempts_df = pd.read_sql_query(
+            """SELECT r.id, s.username, r.score, r.question_ids, r.selected_masks
+            FROM student_quiz_result r
+            JOIN student s ON s.student_id = r.student_id
+            WHERE r.quiz_id = ? AND r.completed = 1 ORDER BY r.id""",
+            reader.conn,
+            params=[quiz_id],
+        )
+    responses_df = score_unpacked(
+        unpack_responses(attempts_df),
+        quiz_questions_df.set_index("id")["answers"],
     )
+    responses_df["grade"] = responses_df["verdict"].map(verdict_symbols)
 
-    # Merging the student reponse for the questions
-    student_quiz_result_df = pd.DataFrame(
-        quiz_details, columns=["id", "student_id", "quiz_id", "completed", "score"]
-    )
-    student_quiz_response_df = pd.DataFrame(
-        student_quiz_response(),
-        columns=["id", "student_quiz_id", "question_id", "selected_option"],
-    )
-    merged_df = student_quiz_result_df.merge(
-        student_quiz_response_df, how="left", left_on="id", right_on="student_quiz_id"
+    # Students x questions matrix, one column per completed attempt
+    grades = (
+        responses_df.pivot(
+            index="question_id", columns="student_quiz_id", values="grade"
+        )
+        .reindex(index=quiz_questions_df["id"], columns=attempts_df["id"])
+        .fillna("")
     )
-
-    for student_id in merged_df["student_id"].unique():
-        student_name = students.get(int(student_id)).username
-        student_responses = merged_df[merged_df["student_id"] == student_id]
-        student_result = [
-            render_evaluated_answer(row) for _, row in student_responses.iterrows()
-        ]
-        student_result.append(student_responses["score"].values[0])
-        table_data[student_name] = student_result
-
-    # Prepare table rows
-    table_rows = list(zip(*table_data.values()))
-
-    # The last row is the total score
-    total_score = table_rows.pop()
-    rows = [Tr(*map(Td, row)) for row in table_rows]
-
-    # Create and return the table
+    rows = [
+        Tr(Td(question), Td(answers), *map(Td, student_grades))
+        for question, answers, student_grades in zip(
+            quiz_questions_df["question"],
+            quiz_questions_df["answers"],
+            grades.itertuples(index=False),
+        )
+    ]
+    header = ["Questions", "Answers", *attempts_df["username"]]
+    total_score = ["Total Score", "", *attempts_df["score"]]
     return Table(
-        Thead(Tr(map(Th, table_data.keys()))),
+        Thead(Tr(map(Th, header))),
         Tbody(*rows),
         Tfoot(Tr(*map(Th, total_score))),
     )
@@ -389,7 +2404,7 @@ def render_quiz_result_table(quiz_id):
 def get(quiz_id: int):
     quiz_id = quiz_id
     score_tb = render_quiz_result_table(quiz_id)
-    quiz_name = quizzes.get(quiz_id).quiz_name
+    quiz_name = get_quiz_snapshot(quiz_id).quiz_name
     header = Grid(
         H3(quiz_name),
         Div(
@@ -397,12 +2412,240 @@ def get(quiz_id: int):
             style="text-align: right",
         ),
     )
-    return Title("Quiz Result"), Container("Quiz Result", header, score_tb)
+    regrade_button = Button(
+        "Regrade",
+        hx_post=f"/regrade/{quiz_id}",
+        target_id="regrade",
+        cls="secondary",
+    )
+    export_button = A(Button("Export"), href=f"/quiz_result/{quiz_id}/export")
+    export_csv_button = A(
+        Button("Export CSV"), href=f"/quiz_result/{quiz_id}/export?format=csv"
+    )
+    return Title("Quiz Result"), Container(
+        "Quiz Result",
+        header,
+        score_tb,
+        Div(regrade_button, id="regrade"),
+        export_button,
+        " ",
+        export_csv_button,
+    )
+
+
+def regrade_attempts(conn, job_id: str, question_ids: list, next_url: str):
+    # Completed attempts of every quiz that contains any of the given questions
+    conn.execute(
+        "CREATE TEMP TABLE regrade_quizzes AS SELECT DISTINCT quiz_id FROM quiz_questions"
+        " WHERE question_id IN (SELECT value FROM json_each(?))",
+        [json.dumps(question_ids)],
+    )
+    attempt_ids = [
+        row[0]
+        for row in conn.execute(
+            """SELECT id FROM student_quiz_result
+            WHERE completed = 1 AND quiz_id IN (SELECT quiz_id FROM regrade_quizzes)
+            ORDER BY id"""
+        )
+    ]
+    answer_keys = pd.read_sql_query(
+        """SELECT id, answers FROM questions WHERE id IN (
+            SELECT question_id FROM quiz_questions
+            WHERE quiz_id IN (SELECT quiz_id FROM regrade_quizzes)
+        )""",
+        conn,
+    ).set_index("id")["answers"]
+    update_job(conn, job_id, total=len(attempt_ids))
+    processed = 0
+    for batch in itertools.batched(attempt_ids, 500):
+        # The whole batch is rescored from one read and written in one transaction
+        attempts = pd.read_sql_query(
+            f"""SELECT id, question_ids, selected_masks FROM student_quiz_result
+            WHERE id IN ({", ".join("?" * len(batch))})""",
+            conn,
+            params=batch,
+        )
+        responses = score_unpacked(unpack_responses(attempts), answer_keys)
+        totals = responses.groupby("student_quiz_id")["points"].agg(["sum", "count"])
+        with transaction(conn):
+            conn.executemany(
+                """UPDATE student_quiz_result SET score = ?, score_points = ?,
+                score_total = ?, version = version + 1 WHERE id = ?""",
+                [
+                    (format_score(points, count), float(points), int(count), attempt_id)
+                    for attempt_id, points, count in totals.itertuples()
+                ],
+            )
+        processed += len(batch)
+        update_job(conn, job_id, processed=processed)
+    # The item statistics were counted with the old keys
+    for (quiz_id,) in conn.execute("SELECT quiz_id FROM regrade_quizzes").fetchall():
+        rebuild_item_stats(conn, quiz_id)
+    update_job(
+        conn, job_id, message=f"Regraded {processed} attempts", next_url=next_url
+    )
+
+
+@route("/quiz_progress/{quiz_id}")
+def get(quiz_id: int):
+    quiz = get_quiz_snapshot(quiz_id)
+    table = Table(
+        Thead(Tr(map(Th, ["Student", "Answered", "Status", "Score"]))),
+        Tbody(id="progress-rows"),
+    )
+    # Rows are filled and kept current by the event stream
+    events = Div(
+        hx_ext="sse",
+        sse_connect=f"/quiz_progress/{quiz_id}/events",
+        sse_swap="message",
+        hx_swap="none",
+    )
+    return Title("Quiz Progress"), Container(
+        Script(src="https://unpkg.com/htmx-ext-sse/sse.js"),
+        H3(quiz.quiz_name),
+        Div(id="progress-summary"),
+        table,
+        events,
+    )
+
+
+# Table parts are wrapped in templates so htmx can parse them on their own
+def render_progress_rows(quiz_id: int):
+    rows, summary = progress_bus.render(quiz_id)
+    all_rows = Tbody(*rows.values(), id="progress-rows", hx_swap_oob="true")
+    return set(rows), sse_message((Template(all_rows), summary))
+
+
+def render_progress_changes(quiz_id: int, changed: set, shown: set):
+    rows, summary = progress_bus.render(quiz_id, changed)
+    updates = [
+        Template(
+            row(hx_swap_oob="true")
+            if attempt_id in shown
+            else Tbody(row, hx_swap_oob="beforeend:#progress-rows")
+        )
+        for attempt_id, row in rows.items()
+    ]
+    return set(rows), sse_message((*updates, summary))
+
+
+@route("/quiz_progress/{quiz_id}/events")
+async def get(quiz_id: int):
+    async def stream():
+        loop, queue = asyncio.get_running_loop(), asyncio.Queue()
+        try:
+            await run_in_threadpool(progress_bus.subscribe, quiz_id, loop, queue)
+            # All rows once, after that only the rows of attempts that changed.
+            # Rendering runs in the thread pool so a big class never blocks the event loop
+            shown, message = await run_in_threadpool(render_progress_rows, quiz_id)
+            yield message
+            while True:
+                changed = {await queue.get()}
+                # Bursts of answers go out as one message
+                await asyncio.sleep(0.5)
+                while not queue.empty():
+                    changed.add(queue.get_nowait())
+                rendered, message = await run_in_threadpool(
+                    render_progress_changes, quiz_id, changed, shown
+                )
+                shown |= rendered
+                yield message
+        finally:
+            progress_bus.unsubscribe(quiz_id, loop, queue)
+
+    return EventStream(stream())
+
+
+def format_rate(rate):
+    return "-" if rate is None else f"{rate:.0%}"
+
+
+@route("/quiz_analytics/{quiz_id}")
+def get(quiz_id: int):
+    quiz = get_quiz_snapshot(quiz_id)
+    items = get_item_analysis(quiz_id)
+    letters = sorted({option for item in items for option in item["options"]})
+    header = [
+        "Question",
+        "Answers",
+        "Attempts",
+        "Difficulty",
+        "Partial",
+        "Discrimination",
+        *letters,
+    ]
+    rows = [
+        Tr(
+            Td(item["question"]),
+            Td(item["answers"]),
+            Td(item["attempts"]),
+            Td(format_rate(item["difficulty"])),
+            Td(format_rate(item["partial_rate"])),
+            Td(
+                "-"
+                if item["discrimination"] is None
+                else f"{item['discrimination']:.2f}"
+            ),
+            *[Td(format_rate(item["options"].get(letter, 0))) for letter in letters],
+        )
+        for item in items
+    ]
+    counted = max((item["attempts"] for item in items), default=0)
+    completed = query(
+        """SELECT COUNT(*) AS count FROM student_quiz_result
+        WHERE quiz_id = ? AND completed = 1""",
+        [quiz_id],
+    )[0]["count"]
+    rebuild = Div(
+        (
+            P(f"Counted {counted} of {completed} submitted attempts")
+            if counted < completed
+            else None
+        ),
+        Button(
+            "Rebuild from history",
+            hx_post=f"/quiz_analytics/{quiz_id}/rebuild",
+            target_id="rebuild",
+            cls="secondary",
+        ),
+        id="rebuild",
+    )
+    return Title("Quiz Analytics"), Container(
+        H3(quiz.quiz_name),
+        Table(Thead(Tr(map(Th, header))), Tbody(*rows)),
+        A("JSON", href=f"/quiz_analytics/{quiz_id}/json"),
+        rebuild,
+    )
+
+
+@route("/quiz_analytics/{quiz_id}/json")
+def get(quiz_id: int):
+    return JSONResponse({"quiz_id": quiz_id, "items": get_item_analysis(quiz_id)})
+
+
+@route("/quiz_analytics/{quiz_id}/rebuild")
+def post(quiz_id: int):
+    job_id = start_job(
+        "Rebuild statistics",
+        rebuild_item_stats_job,
+        [quiz_id],
+        f"/quiz_analytics/{quiz_id}",
+    )
+    return render_job_progress(job_id)
+
+
+@route("/regrade/{quiz_id}")
+def post(quiz_id: int):
+    question_ids = [question.id for question in get_quiz_snapshot(quiz_id).questions]
+    job_id = start_job(
+        "Regrade", regrade_attempts, question_ids, f"/quiz_result/{quiz_id}"
+    )
+    return render_job_progress(job_id)
 
 
 @route("/all_quizzes")
 def get():
-    all_quizzes = map(render_quiz_details_for_teacher, quizzes())
+    all_quizzes = map(render_quiz_details_for_teacher, get_teacher_quiz_rows())
     table = Table(
         Thead(
             Tr(
@@ -410,55 +2653,296 @@ def get():
                 Th("Total Questions"),
                 Th("Preview"),
                 Th("Result"),
+                Th("Progress"),
+                Th("Analytics"),
             )
         ),
         Tbody(*all_quizzes),
     )
     home_button = A(Button("Home"), href="/")
-    container = Container(table, home_button)
+    gradebook_button = A(Button("Export gradebook"), href="/gradebook/export")
+    container = Container(table, home_button, " ", gradebook_button)
     return Titled("All Quizzes", container)
 
 
 @route("/select_question")
-def post(question_id: int):
-    if question_id in selected_questions_id:
-        selected_questions_id.remove(question_id)
-        return "⬜"
-    else:
-        selected_questions_id.append(question_id)
-        return "✅"
+def post(question_id: int, session):
+    selected = selection_store.toggle(get_selection_id(session), question_id)
+    return "✅" if selected else "⬜"
+
+
+## Export ##
+
+
+class ZipStream(io.RawIOBase):
+    # Write-only sink for zipfile, drained after every chunk so nothing accumulates
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+xlsx_parts = {
+    "[Content_Types].xml": """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+<Override PartName="/xl/tables/table1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.table+xml"/>
+</Types>""",
+    "_rels/.rels": """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>""",
+    "xl/workbook.xml": """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets>
+</workbook>""",
+    "xl/_rels/workbook.xml.rels": """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>""",
+    # Cell style 1 wraps text
+    "xl/styles.xml": """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0" applyAlignment="1"><alignment wrapText="1" vertical="top"/></xf></cellXfs>
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>
+</styleSheet>""",
+    "xl/worksheets/_rels/sheet1.xml.rels": """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/table" Target="../tables/table1.xml"/>
+</Relationships>""",
+}
 
+# Characters that are not allowed anywhere in an XML document
+invalid_xml_chars = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
 
-@route("/download")
-def get():
-    df = pd.DataFrame(questions()).drop("id", axis=1).rename(columns=str.capitalize)
-    # Create a temporary directory to store the Excel file becasue xlwings doesn't support direct streaming
-    temp_dir = tempfile.mkdtemp()
-    temp_file_path = os.path.join(temp_dir, "quiz_data.xlsx")
+
+# Util function
+def column_letter(number: int):
+    letters = ""
+    while number:
+        number, remainder = divmod(number - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+# Util function
+def xlsx_row(row_number: int, values):
+    cells = "".join(
+        f'<c r="{column_letter(column)}{row_number}" t="inlineStr" s="1">'
+        f'<is><t xml:space="preserve">{escape(invalid_xml_chars.sub("", str(value)))}</t></is></c>'
+        for column, value in enumerate(values, start=1)
+        if value is not None
+    )
+    return f'<row r="{row_number}">{cells}</row>'
+
+
+def stream_xlsx(headers: list, rows, table_name: str, chunk_size: int = 500):
+    # Builds the workbook zip entry by entry while the rows are read from the cursor
+    sink = ZipStream()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as workbook:
+        for name, content in xlsx_parts.items():
+            workbook.writestr(name, content)
+        row_count = 0
+        with workbook.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write(
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+                ' xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+                f'<cols><col min="1" max="{len(headers)}" width="35" customWidth="1"/></cols>'
+                f"<sheetData>{xlsx_row(1, headers)}".encode()
+            )
+            for chunk in itertools.batched(rows, chunk_size):
+                sheet.write(
+                    "".join(
+                        xlsx_row(row_number, values)
+                        for row_number, values in enumerate(chunk, start=row_count + 2)
+                    ).encode()
+                )
+                row_count += len(chunk)
+                yield sink.drain()
+            sheet.write(
+                b'</sheetData><tableParts count="1"><tablePart r:id="rId1"/></tableParts></worksheet>'
+            )
+        # The table range is only known once every row has been written
+        table_range = f"A1:{column_letter(len(headers))}{max(row_count, 1) + 1}"
+        table_columns = "".join(
+            f'<tableColumn id="{i}" name="{escape(header)}"/>'
+            for i, header in enumerate(headers, start=1)
+        )
+        workbook.writestr(
+            "xl/tables/table1.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<table xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+            f' id="1" name="{table_name}" displayName="{table_name}" ref="{table_range}">'
+            f'<autoFilter ref="{table_range}"/>'
+            f'<tableColumns count="{len(headers)}">{table_columns}</tableColumns>'
+            '<tableStyleInfo name="TableStyleMedium2" showRowStripes="1"/></table>',
+        )
+    yield sink.drain()
+
+
+def stream_csv(headers: list, rows, chunk_size: int = 500):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # The byte order mark makes Excel open the file as UTF-8
+    buffer.write("\ufeff")
+    writer.writerow(headers)
+    for chunk in itertools.batched(rows, chunk_size):
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+# Util function
+def stream_query(sql: str, params=()):
+    # Long exports read with a connection of their own instead of holding a pooled reader
+    conn = connect(read_only=True)
     try:
-        with xw.App(visible=False) as app:
-            workbook = app.books.add()
-            sheet = workbook.sheets.active
-            starting_cell = sheet.range("A1")
-            starting_cell.options(index=False).value = df
-            table_range = starting_cell.expand("table")
-            table = sheet.tables.add(table_range, name="Quiz_table")
-            table.range.column_width = 35
-            table.range.api.WrapText = True
-
-            workbook.save(temp_file_path)
-        # For streaming we need to read the file content into a BytesIO object
-        with open(temp_file_path, "rb") as file_content:
-            output = BytesIO(file_content.read())
+        yield from conn.execute(sql, params)
     finally:
-        os.remove(temp_file_path)
-        os.rmdir(temp_dir)
+        conn.close()
 
-    headers = {
-        "Content-Disposition": "attachment; filename=quiz_data.xlsx",
-        "Content-Type": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",  # This is to tell the browser that this is an excel file
+
+export_media_types = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",  # This is to tell the browser that this is an excel file
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+def export_response(
+    filename: str, headers: list, rows, file_format: str, table_name: str
+):
+    if file_format == "csv":
+        content = stream_csv(headers, rows)
+    else:
+        file_format = "xlsx"
+        content = stream_xlsx(headers, rows, table_name)
+    return StreamingResponse(
+        content,
+        media_type=export_media_types[file_format],
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}.{file_format}"
+        },
+    )
+
+
+@route("/download")
+def get(format: str = "xlsx"):
+    rows = stream_query(
+        f"SELECT {", ".join(question_columns)} FROM questions ORDER BY id"
+    )
+    headers = [column.capitalize() for column in question_columns]
+    return export_response("quiz_data", headers, rows, format, table_name="Quiz_table")
+
+
+quiz_result_headers = [
+    "Student",
+    "Question",
+    "Answers",
+    "Selected",
+    "Verdict",
+    "Points",
+    "Score",
+]
+
+
+def quiz_result_rows(quiz_id: int):
+    # One row per answer, decoded from the packed attempts one at a time as the cursor goes
+    questions = {
+        question.id: question for question in get_quiz_snapshot(quiz_id).questions
     }
-    return StreamingResponse(output, headers=headers)
+    answer_masks = {
+        question_id: option_mask(question.answers)
+        for question_id, question in questions.items()
+    }
+    attempts = stream_query(
+        """SELECT s.username, r.score, r.question_ids, r.selected_masks
+        FROM student_quiz_result r JOIN student s ON s.student_id = r.student_id
+        WHERE r.quiz_id = ? AND r.completed = 1 ORDER BY r.id""",
+        [quiz_id],
+    )
+    for username, score, question_ids, selected_masks in attempts:
+        question_ids = unpack_question_ids(question_ids)
+        masks = unpack_masks(selected_masks).astype(np.uint32)
+        # Answers to deleted questions are not scored, as everywhere else
+        kept = np.isin(question_ids, list(questions))
+        question_ids, masks = question_ids[kept], masks[kept]
+        key_masks = np.array(
+            [answer_masks[int(question_id)] for question_id in question_ids],
+            dtype=np.uint32,
+        )
+        points, verdicts = score_masks(key_masks, masks)
+        for question_id, mask, question_points, verdict in zip(
+            question_ids, masks, points, verdicts
+        ):
+            question = questions[int(question_id)]
+            yield (
+                username,
+                question.question,
+                question.answers,
+                mask_options(mask),
+                verdict,
+                f"{round(float(question_points), 1):g}",
+                score,
+            )
+
+
+def gradebook_rows(quiz_ids: list):
+    # One row per student with a score column per quiz, students stream in username order
+    rows = stream_query(
+        """SELECT s.username, r.quiz_id, r.score FROM student s
+        LEFT JOIN student_quiz_result r
+            ON r.student_id = s.student_id AND r.completed = 1
+        ORDER BY s.username"""
+    )
+    for username, attempts in itertools.groupby(rows, key=lambda row: row[0]):
+        scores = {quiz_id: score for _, quiz_id, score in attempts}
+        yield (username, *(scores.get(quiz_id) for quiz_id in quiz_ids))
+
+
+@route("/quiz_result/{quiz_id}/export")
+def get(quiz_id: int, format: str = "xlsx"):
+    rows = quiz_result_rows(quiz_id)
+    return export_response(
+        f"quiz_result_{quiz_id}",
+        quiz_result_headers,
+        rows,
+        format,
+        table_name="Quiz_result",
+    )
+
+
+@route("/gradebook/export")
+def get(format: str = "xlsx"):
+    quiz_list = query("SELECT id, quiz_name FROM quizzes ORDER BY id")
+    # Quiz names needn't be unique or set, but an xlsx table needs distinct headers
+    headers = [
+        "Student",
+        *(f"{quiz['quiz_name'] or 'Quiz'} ({quiz['id']})" for quiz in quiz_list),
+    ]
+    rows = gradebook_rows([quiz["id"] for quiz in quiz_list])
+    return export_response("gradebook", headers, rows, format, table_name="Gradebook")
 
 
 ## Student Pages ##
@@ -482,53 +2966,74 @@ def get():
 def post(student: Students, session):  # type: ignore
     username = student.username
     try:
-        students.insert(student)
-    except sqlite3.IntegrityError:
-        # If the username already exists, do nothing
-        pass
+        session["student_id"] = get_or_create_student_id(username)
     except Exception as e:
         return P(e)
     session["auth"] = username
     return RedirectResponse("/student/quiz", status_code=303)
 
 
-def render_quiz_details_for_student(quiz_data, student_id):
-    quiz = quizzes.get(quiz_data.id)
-    question_count = len(get_question_ids_by_quiz_id(quiz_data.id))
+# Util function
+def get_or_create_student_id(username: str):
+    # Returning students are found with a read, only new ones take the write lock
+    existing = query("SELECT student_id FROM student WHERE username = ?", [username])
+    if existing:
+        return existing[0]["student_id"]
+    with transaction(db):
+        # The no-op update makes RETURNING work when another login created the row first
+        return db.execute(
+            """INSERT INTO student (username) VALUES (?)
+            ON CONFLICT (username) DO UPDATE SET username = excluded.username
+            RETURNING student_id""",
+            [username],
+        ).fetchone()[0]
+
+
+# Util function
+def get_student_dashboard_rows(student_id: int):
+    # One aggregated row per quiz with this student's attempt
+    return query(
+        """SELECT z.id, z.quiz_name, COALESCE(qc.question_count, 0) AS question_count,
+            r.id AS student_quiz_id, r.completed, r.score
+        FROM quizzes z
+        LEFT JOIN (
+            SELECT quiz_id, COUNT(*) AS question_count
+            FROM quiz_questions GROUP BY quiz_id
+        ) qc ON qc.quiz_id = z.id
+        LEFT JOIN student_quiz_result r ON r.quiz_id = z.id
+            AND r.student_id = ?
+        ORDER BY z.id""",
+        [student_id],
+    )
 
-    try:
-        student_quiz_details = get_student_quiz_id(student_id, quiz_data.id)[0]
-    except IndexError:
-        is_completed = False
-    else:
-        is_completed = student_quiz_details["completed"]
 
-    if is_completed:
+def render_quiz_details_for_student(quiz_data: dict):
+    if quiz_data["completed"]:
         action_button = A(
-            "Result", href=f"/student/quiz/{student_quiz_details["id"]}/result"
+            "Result", href=f"/student/quiz/{quiz_data["student_quiz_id"]}/result"
         )
-        score = student_quiz_details["score"]
+        score = quiz_data["score"]
     else:
-        action_button = A("Take", href=f"/student/take_quiz/{quiz_data.id}")
+        action_button = A("Take", href=f"/student/take_quiz/{quiz_data["id"]}")
         score = "-"
 
     return Tr(
-        Td(quiz.quiz_name),
-        Td(question_count),
+        Td(quiz_data["quiz_name"]),
+        Td(quiz_data["question_count"]),
         Td(score),
         Td(action_button),
     )
 
 
 @route("/student/quiz")
-def get(auth):
+def get(auth, req):
     header = Grid(
         H1(f"Welcome {auth}"),
         Div(A("logout", href="/student/logout"), style="text-align: right"),
     )
-    student_id = get_student_id_by_name(auth)
     all_quizzes = map(
-        lambda quiz: render_quiz_details_for_student(quiz, student_id), quizzes()
+        render_quiz_details_for_student,
+        get_student_dashboard_rows(req.scope["student_id"]),
     )
     table = Table(
         Thead(
@@ -545,220 +3050,369 @@ def get(auth):
 
 
 def generate_navigation_button(button_name: str, url: str, cls_name=None):
-    method = {"hx_post": url} if button_name == "Submit" else {"hx_get": url}
+    if button_name == "Submit":
+        method = {"hx_post": url, "hx_replace_url": "true"}
+    else:
+        # The question fragment comes back in one swap and gets its own history entry
+        method = {"hx_get": url, "hx_push_url": "true"}
     return Button(
         button_name,
         **method,
-        hx_replace_url="true",
         target_id="quiz_container",
         hx_swap="outerHTML",
         cls=cls_name,
     )
 
 
-# Util function
-def get_student_id_by_name(student_name: str):
-    query = "username = ?"
-    student = list(students.rows_where(query, [student_name]))
-    return student[0]["student_id"]
-
-
-# Util function
-def get_student_quiz_id(student_id: int, quiz_id: int):
-    data = list(
-        student_quiz_result.rows_where(
-            "student_id = ? AND quiz_id = ?", [student_id, quiz_id]
-        )
+def preloading_student_score(quiz_id: int, student_id: int):
+    # (attempt id, question ids) when this visit starts the attempt, otherwise None.
+    # Attempts created ahead by the roster import or an earlier visit are only read
+    existing = query(
+        """SELECT id, question_ids, started_at FROM student_quiz_result
+        WHERE student_id = ? AND quiz_id = ?""",
+        [student_id, quiz_id],
     )
-    return data
+    if existing:
+        attempt = existing[0]
+        if attempt["started_at"]:
+            return None
+        # Written with the next autosave, so opening the quiz still takes no write lock
+        answer_buffer.mark_started(attempt["id"])
+        return attempt["id"], unpack_question_ids(attempt["question_ids"]).tolist()
+    question_ids = [
+        row["question_id"]
+        for row in query(
+            "SELECT question_id FROM quiz_questions WHERE quiz_id = ? ORDER BY question_id",
+            [quiz_id],
+        )
+    ]
+    with transaction(db):
+        # Does nothing if the student has already started or submitted the quiz
+        # Every question starts with an empty selection in its slot
+        created = db.execute(
+            """INSERT INTO student_quiz_result
+                (student_id, quiz_id, completed, question_ids, selected_masks, started_at)
+            VALUES (?, ?, 0, ?, zeroblob(?), CURRENT_TIMESTAMP)
+            ON CONFLICT (student_id, quiz_id) DO NOTHING RETURNING id""",
+            [student_id, quiz_id, pack_question_ids(question_ids), len(question_ids)],
+        ).fetchone()
+    return (created[0], question_ids) if created else None
 
 
 # Util function
-def get_student_score_rows(student_quiz_id: int, question_id: int):
-    data = list(
-        student_quiz_response.rows_where(
-            "student_quiz_id = ? AND question_id = ?", [student_quiz_id, question_id]
+def get_student_responses(student_id: int, quiz_id: int):
+    # Every answer of the attempt keyed by question id, including the autosaved ones
+    with read_db() as reader:
+        attempt = reader.q(
+            """SELECT id, question_ids, selected_masks FROM student_quiz_result
+            WHERE student_id = ? AND quiz_id = ?""",
+            [student_id, quiz_id],
+        )[0]
+        pending = reader.q(
+            "SELECT slot, mask FROM pending_answers WHERE attempt_id = ?",
+            [attempt["id"]],
         )
+    selected_masks = with_pending_answers(
+        attempt["selected_masks"], [(row["slot"], row["mask"]) for row in pending]
     )
-    return data
-
-
-def preloading_student_score(quiz_id: int, student_name: str):
-    student_id = get_student_id_by_name(student_name)
-    # Check if the student has already started or submitted the quiz
-    try:
-        student_quiz_id = get_student_quiz_id(student_id, quiz_id)[0]
-    except IndexError:
-        student_quiz_id = student_quiz_result.insert(
-            StudentQuizResult(student_id=student_id, quiz_id=quiz_id, completed=False)
-        )
-    else:
-        return None
-    # Prepopulate the student_score table for storing the selected answers
-    questions_id = get_question_ids_by_quiz_id(quiz_id)
-    for question_id in questions_id:
-        data = StudentQuizResponse(
-            student_quiz_id=student_quiz_id.id,
-            question_id=question_id,
-            selected_option="",
+    return {
+        int(question_id): {
+            "quiz_id": quiz_id,
+            "student_quiz_id": attempt["id"],
+            "slot": slot,
+            "selected_option": mask_options(mask),
+        }
+        for slot, (question_id, mask) in enumerate(
+            zip(
+                unpack_question_ids(attempt["question_ids"]),
+                unpack_masks(selected_masks),
+            )
         )
-        student_quiz_response.insert(data)
-
-
-def get_anwser_by_question_id(question_id: int):
-    return questions.get(question_id).answers
+    }
 
 
-def render_quiz_question(quiz_id: int, question_no: int, student_name: str):
-    current_quiz_question_ids = get_question_ids_by_quiz_id(quiz_id)
-    quiz_questions = get_questions_by_question_ids(current_quiz_question_ids)
-    # First question is at index 0 and question_no starts from 1
-    question = quiz_questions[question_no - 1]
-    header = H5(f"{question_no}) {question["question"]}")
-    student_id = get_student_id_by_name(student_name)
-    student_quiz_id = get_student_quiz_id(student_id, quiz_id)[0]["id"]
-    score = get_student_score_rows(student_quiz_id, question["id"])
-    score = score[0]
-    answers = get_anwser_by_question_id(question["id"])
-    # print(score)
+def render_question_card(
+    question: QuizQuestion, question_no: int, score: dict, footer=None
+):
+    header = H5(f"{question_no}) {question.question}")
+    selected_option = score["selected_option"]
     # Create a radio button for the available options only
     # And preselect the option that the student has already selected for it to retain the selected option when navigating to the next question.
     options = [
         Label(
             Input(
-                type="checkbox" if len(answers) > 1 else "radio",
+                type="checkbox" if len(question.answers) > 1 else "radio",
                 name="selected_option",
-                value=option.upper(),
-                checked=(True if option.upper() in score["selected_option"] else False),
+                value=option,
+                checked=(True if option in selected_option else False),
             ),
-            Span(question[option]),
+            Span(text),
         )
-        for option in ["a", "b", "c", "d"]
-        if question[option]
+        for option, text in question.options
     ]
     form = Form(
         *options,
-        Hidden(name="score_id", value=score["id"]),
+        Hidden(name="quiz_id", value=score["quiz_id"]),
+        Hidden(name="student_quiz_id", value=score["student_quiz_id"]),
+        Hidden(name="slot", value=str(score["slot"])),
         hx_post="/student/quiz/answer",
         hx_swap="none",
         hx_trigger="change",  # It will trigger the for every action in the checkbox or radio button
     )
+    return Card(form, header=header, footer=footer)
 
-    previous_button = generate_navigation_button(
-        "Previous", url=f"/student/quiz/previous/{quiz_id}/question/{question_no}"
-    )
-    next_button = generate_navigation_button(
-        "Next", url=f"/student/quiz/next/{quiz_id}/question/{question_no}"
-    )
+
+def render_quiz_footer(
+    question_no: int, question_count: int, student_quiz_id: int, previous, next
+):
     submit_button = generate_navigation_button(
         "Submit",
         url=f"/student/quiz/submit/{student_quiz_id}",
         cls_name="contrast",
     )
-
-    footer = Grid(
-        previous_button if question_no > 1 else None,
+    return Grid(
+        previous if question_no > 1 else None,
         Div(
-            submit_button if question_no == len(quiz_questions) else next_button,
+            submit_button if question_no == question_count else next,
             style="text-align: right",
         ),
     )
-    return Card(form, header=header, footer=footer)
+
+
+def render_quiz_question(quiz: QuizSnapshot, question_no: int, student_id: int):
+    # First question is at index 0 and question_no starts from 1
+    question = quiz.questions[question_no - 1]
+    score = get_student_responses(student_id, quiz.id)[question.id]
+    question_url = f"/student/take_quiz/{quiz.id}/question"
+    footer = render_quiz_footer(
+        question_no,
+        len(quiz.questions),
+        score["student_quiz_id"],
+        generate_navigation_button("Previous", url=f"{question_url}/{question_no - 1}"),
+        generate_navigation_button("Next", url=f"{question_url}/{question_no + 1}"),
+    )
+    return render_question_card(question, question_no, score, footer)
+
+
+# Shows the question named in the URL fragment, so the browser history keeps working
+show_question_script = Script(
+    """
+function showQuestion() {
+    const current = location.hash || "#question-1";
+    document.querySelectorAll(".quiz-question").forEach((question) => {
+        question.hidden = "#" + question.id !== current;
+    });
+}
+window.addEventListener("hashchange", showQuestion);
+showQuestion();
+"""
+)
+
+
+def render_whole_quiz(quiz: QuizSnapshot, student_id: int):
+    # Every question goes out in one payload and navigation never hits the server
+    responses = get_student_responses(student_id, quiz.id)
+    cards = []
+    for question_no, question in enumerate(quiz.questions, start=1):
+        score = responses[question.id]
+        footer = render_quiz_footer(
+            question_no,
+            len(quiz.questions),
+            score["student_quiz_id"],
+            A("Previous", href=f"#question-{question_no - 1}", role="button"),
+            A("Next", href=f"#question-{question_no + 1}", role="button"),
+        )
+        cards.append(
+            Div(
+                render_question_card(question, question_no, score, footer),
+                id=f"question-{question_no}",
+                cls="quiz-question",
+            )
+        )
+    return cards
 
 
 @route("/student/take_quiz/{quiz_id}")
-def get(quiz_id: int, auth):
-    preloading_student_score(quiz_id, student_name=auth)
+def get(quiz_id: int, auth, req):
+    created = preloading_student_score(quiz_id, student_id=req.scope["student_id"])
+    if created:
+        attempt_id, question_ids = created
+        progress_bus.publish(quiz_id, "start", attempt_id, auth, question_ids)
+    if WHOLE_QUIZ_MODE:
+        return RedirectResponse(f"/student/take_quiz/{quiz_id}/all", status_code=303)
     return RedirectResponse(f"/student/take_quiz/{quiz_id}/question/1", status_code=303)
 
 
+# Util function
+def get_slot_options(student_quiz_id: int, student_id: int, quiz_id: int, slot: int):
+    # Option letters of the question in the slot, None when the attempt takes no answers.
+    # Only the student's own attempt takes answers, and only until it is submitted
+    attempt = query(
+        """SELECT question_ids FROM student_quiz_result
+        WHERE id = ? AND student_id = ? AND quiz_id = ? AND completed = 0""",
+        [student_quiz_id, student_id, quiz_id],
+    )
+    if not attempt:
+        return None
+    question_ids = unpack_question_ids(attempt[0]["question_ids"])
+    if not 0 <= slot < len(question_ids):
+        return ""
+    for question in get_quiz_snapshot(quiz_id).questions:
+        if question.id == question_ids[slot]:
+            return "".join(option for option, _ in question.options)
+    return ""
+
+
 @route("/student/quiz/answer")
-async def post(score_id: int, req):  # type:ignore
+async def post(quiz_id: int, student_quiz_id: int, slot: int, req):  # type:ignore
+    options = await run_in_threadpool(
+        get_slot_options, student_quiz_id, req.scope["student_id"], quiz_id, slot
+    )
+    if options is None:
+        return Response("This attempt can no longer be answered", status_code=409)
     form_data = await req.form()
     del_values = form_data.getlist("selected_option")
+    # Anything but the question's own options could be neither stored nor scored
+    if not options or not set(del_values) <= set(options):
+        return Response("Not an option of this question", status_code=400)
     selected_option = "".join(del_values)
-
-    score = student_quiz_response.get(score_id)
-    score.selected_option = selected_option
-    student_quiz_response.update(score)
-
-
-@route("/student/quiz/next/{quiz_id}/question/{question_no}")
-def get(quiz_id: int, question_no: int):
-    return RedirectResponse(f"/student/take_quiz/{quiz_id}/question/{question_no + 1}")
-
-
-@route("/student/quiz/previous/{quiz_id}/question/{question_no}")
-def get(quiz_id: int, question_no: int):
-    return RedirectResponse(f"/student/take_quiz/{quiz_id}/question/{question_no - 1}")
+    saved = await run_in_threadpool(
+        answer_buffer.put, student_quiz_id, slot, option_mask(selected_option)
+    )
+    if not saved:
+        return Response("This attempt can no longer be answered", status_code=409)
+    progress_bus.publish(
+        quiz_id, "answer", student_quiz_id, slot, option_mask(selected_option)
+    )
 
 
 @route("/student/quiz/submit/{student_quiz_id}")
-def post(student_quiz_id: int):
-    # Calculate the total score
-    total_score = 0
-    quiz_questions_with_answers = evaluate_answers(student_quiz_id)
-    for question in quiz_questions_with_answers:
-        answer_length = len(question["answers"])
-        for option in question["selected_option"]:
-            if option in question["answers"]:
-                score = 1 / answer_length
-                total_score += score
-    total_score = (
-        int(total_score) if total_score.is_integer() else round(total_score, 1)
-    )
-
-    total_score_string = f"{total_score}/{len(quiz_questions_with_answers)}"
-    # Update the student_quiz_result table
-    student_quiz = student_quiz_result.get(student_quiz_id)
-    student_quiz.score = total_score_string
-    student_quiz.completed = True
-    student_quiz_result.update(student_quiz)
+def post(student_quiz_id: int, req):
+    with transaction(db):
+        # Answers autosaved by any worker are folded in first, so the score sees them all
+        fold_pending_answers(db.conn, student_quiz_id)
+        # Only the student's own attempt can be submitted
+        attempt = pd.DataFrame(
+            db.execute(
+                """SELECT id, quiz_id, question_ids, selected_masks, completed
+                FROM student_quiz_result WHERE id = ? AND student_id = ?""",
+                [student_quiz_id, req.scope["student_id"]],
+            ).fetchall(),
+            columns=["id", "quiz_id", "question_ids", "selected_masks", "completed"],
+        )
+        if attempt.empty:
+            return Response("Attempt not found", status_code=404)
+        # A second submit of the same attempt changes nothing
+        submitted = not attempt["completed"][0]
+        if submitted:
+            # Calculate the total score
+            quiz_id = int(attempt["quiz_id"][0])
+            scored = score_unpacked(
+                unpack_responses(attempt), quiz_answer_keys(quiz_id)
+            )
+            points = scored["points"].sum()
+            total_score_string = format_score(points, len(scored))
+            db.execute(
+                """UPDATE student_quiz_result SET score = ?, score_points = ?,
+                    score_total = ?, completed = 1 WHERE id = ? AND student_id = ?""",
+                [
+                    total_score_string,
+                    points,
+                    len(scored),
+                    student_quiz_id,
+                    req.scope["student_id"],
+                ],
+            )
+            add_item_counters(db.conn, quiz_id, item_counters(scored))
+    if submitted:
+        progress_bus.publish(quiz_id, "submit", student_quiz_id, total_score_string)
     return RedirectResponse(f"/student/quiz/{student_quiz_id}/result", status_code=303)
 
 
-@route("/student/quiz/{student_quiz_id}/result")
-def get(student_quiz_id: int):
-    student_quiz = student_quiz_result.get(student_quiz_id)
-    quiz_name = quizzes.get(student_quiz.quiz_id).quiz_name
+def render_student_result(student_quiz: dict):
+    student_quiz_id = student_quiz["id"]
+    quiz_name = get_quiz_snapshot(student_quiz["quiz_id"]).quiz_name
     header = f"Quiz: {quiz_name}"
     back_button = A(Button("Home"), href="/student/quiz")
     quiz_questions_with_answers = evaluate_answers(student_quiz_id)
+    _, verdicts = score_responses(
+        [question["answers"] for question in quiz_questions_with_answers],
+        [question["selected_option"] for question in quiz_questions_with_answers],
+    )
     answers = []
-    for i, question in enumerate(quiz_questions_with_answers, start=1):
-        answers.append(render_quiz_result(question, i))
-    return Titled(header, P(f"Score: {student_quiz.score}"), *answers, back_button)
+    for i, (question, verdict) in enumerate(
+        zip(quiz_questions_with_answers, verdicts), start=1
+    ):
+        answers.append(render_quiz_result(question, i, verdict))
+    return Titled(header, P(f"Score: {student_quiz['score']}"), *answers, back_button)
 
 
-def evaluate_answers(student_quiz_id: int):
-    selected_options = list(
-        student_quiz_response.rows_where("student_quiz_id = ?", [student_quiz_id])
+@route("/student/quiz/{student_quiz_id}/result")
+def get(student_quiz_id: int, req):
+    attempt = query(
+        """SELECT id, quiz_id, completed, score, version
+        FROM student_quiz_result WHERE id = ? AND student_id = ?""",
+        [student_quiz_id, req.scope["student_id"]],
+    )
+    # Another student's attempt is as missing as one that doesn't exist
+    if not attempt:
+        return Response("Attempt not found", status_code=404)
+    student_quiz = attempt[0]
+    if not student_quiz["completed"]:
+        return render_student_result(student_quiz)
+    # A completed attempt only changes when it is regraded or the bank is imported
+    return render_cached_page(
+        req,
+        ("result", student_quiz_id, student_quiz["version"], bank_version()),
+        lambda: render_student_result(student_quiz),
     )
-    quiz_questions_with_answers = []
-    for question in selected_options:
-        current_question = questions.get(question["question_id"]).__dict__
-        current_question["student_quiz_id"] = question["student_quiz_id"]
-        current_question["selected_option"] = question["selected_option"]
-        quiz_questions_with_answers.append(current_question)
-    return quiz_questions_with_answers
 
 
-def render_quiz_result(question: dict, question_no: int):
-    header = H5(f"{question_no}) {question['question']}")
+def evaluate_answers(student_quiz_id: int):
+    # Every question of the attempt with the student's selection
+    with read_db() as reader:
+        attempt = reader.q(
+            "SELECT question_ids, selected_masks FROM student_quiz_result WHERE id = ?",
+            [student_quiz_id],
+        )[0]
+        question_ids = unpack_question_ids(attempt["question_ids"]).tolist()
+        selected = dict(
+            zip(
+                question_ids, map(mask_options, unpack_masks(attempt["selected_masks"]))
+            )
+        )
+        questions = reader.q(
+            """SELECT * FROM questions
+            WHERE id IN (SELECT value FROM json_each(?)) ORDER BY id""",
+            [json.dumps(question_ids)],
+        )
+    return [
+        {
+            **question,
+            "student_quiz_id": student_quiz_id,
+            "selected_option": selected[question["id"]],
+        }
+        for question in questions
+    ]
+
+
+def render_quiz_result(question: dict, question_no: int, verdict: str):
+    header = H5(f"{question_no}) {question['question']} {verdict_symbols[verdict]}")
+    selected_mask = option_mask(question["selected_option"])
+    answer_mask = option_mask(question["answers"])
     question_option = []
-    for option in ["a", "b", "c", "d"]:
+    for bit, option in enumerate(["a", "b", "c", "d"]):
         if question[option]:
             is_invalid = "None"
             is_checked = None
-            selected_option = question["selected_option"].lower()
-            correct_answer = question["answers"].lower()
-            if option in correct_answer:
+            option_bit = 1 << bit
+            if answer_mask & option_bit:
                 # set the correct answer as a green checkmark
                 is_invalid = "false"
-            if option in selected_option:
+            if selected_mask & option_bit:
                 is_checked = True
-            if option in selected_option and not option in correct_answer:
-                is_invalid = "true"
+                if not answer_mask & option_bit:
+                    is_invalid = "true"
 
             question_option.append(
                 Label(
@@ -776,18 +3430,33 @@ def render_quiz_result(question: dict, question_no: int):
 
 
 @route("/student/take_quiz/{quiz_id}/question/{question_no}")
-def get(quiz_id: int, question_no: int, auth):
-    current_quiz = quizzes.get(quiz_id)
-    quiz_name = current_quiz.quiz_name
-    current_question = render_quiz_question(quiz_id, question_no, student_name=auth)
-    return Container(H3(f"Quiz: {quiz_name}"), current_question, id="quiz_container")
+def get(quiz_id: int, question_no: int, req):
+    quiz = get_quiz_snapshot(quiz_id)
+    current_question = render_quiz_question(
+        quiz, question_no, student_id=req.scope["student_id"]
+    )
+    return Container(
+        H3(f"Quiz: {quiz.quiz_name}"), current_question, id="quiz_container"
+    )
+
+
+@route("/student/take_quiz/{quiz_id}/all")
+def get(quiz_id: int, req):
+    quiz = get_quiz_snapshot(quiz_id)
+    questions = render_whole_quiz(quiz, student_id=req.scope["student_id"])
+    return Container(
+        H3(f"Quiz: {quiz.quiz_name}"),
+        *questions,
+        show_question_script,
+        id="quiz_container",
+    )
 
 
 @route("/student/logout")
 def get(sess):
-    if "auth" in sess:
-        del sess["auth"]
+    sess.pop("auth", None)
+    sess.pop("student_id", None)
     return login_redir
 
 
-serve()
+serve(reload=not PRODUCTION)
@@ -0,0 +1,299 @@
+import asyncio
+import json
+import os
+import random
+import re
+import sqlite3
+import statistics
+import time
+from pathlib import Path
+
+import httpx
+import pytest
+
+# The exam takes tens of seconds, so the benchmark only runs when asked for
+pytestmark = pytest.mark.skipif(
+    os.environ.get("LMS_BENCH") != "1",
+    reason="Set LMS_BENCH=1 to run the exam-day benchmark",
+)
+
+# Scale of the simulated exam, override through the environment
+question_count = int(os.environ.get("LMS_BENCH_QUESTIONS", 500))
+quiz_size = int(os.environ.get("LMS_BENCH_QUIZ_SIZE", 20))
+student_count = int(os.environ.get("LMS_BENCH_STUDENTS", 50))
+concurrency = int(os.environ.get("LMS_BENCH_CONCURRENCY", 25))
+result_views = int(os.environ.get("LMS_BENCH_RESULT_VIEWS", 20))
+# A route fails when its p50, relative to the reference workload timed on the same
+# host, is this many times the baseline's
+tolerance = float(os.environ.get("LMS_BENCH_TOLERANCE", 1.5))
+# Set LMS_BENCH_UPDATE=1 to store this run as the new baseline
+update_baseline = os.environ.get("LMS_BENCH_UPDATE") == "1"
+
+baseline_path = Path(__file__).parent / "benchmark_baseline.json"
+scale = {
+    "questions": question_count,
+    "quiz_size": quiz_size,
+    "students": student_count,
+    "concurrency": concurrency,
+}
+
+
+@pytest.fixture(scope="module")
+def main(tmp_path_factory):
+    # The app opens its database on import, so point it at a scratch file first
+    workdir = tmp_path_factory.mktemp("benchmark")
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("LMS_DB_PATH", str(workdir / "quiz.db"))
+        patch.chdir(workdir)  # the session key file is written to the working directory
+        patch.syspath_prepend(str(Path(__file__).parent.parent))
+        import main
+
+        main.answer_buffer.start()
+        yield main
+        main.answer_buffer.stop()
+
+
+def seed(main):
+    rng = random.Random(42)
+    questions = []
+    for number in range(question_count):
+        question = {
+            "question": f"Synthetic question {number}",
+            "a": f"Option A of {number}",
+            "b": f"Option B of {number}",
+            "c": f"Option C of {number}",
+            "d": f"Option D of {number}",
+            "answers": "".join(sorted(rng.sample("ABCD", rng.choice([1, 1, 1, 2])))),
+            "tag": f"T{number % 10}",
+        }
+        questions.append(
+            [
+                *(question[column] for column in main.question_columns),
+                main.question_hash(question),
+            ]
+        )
+    with main.transaction(main.db):
+        main.db.conn.executemany(
+            f"""INSERT INTO questions ({", ".join(main.question_columns)}, content_hash)
+            VALUES ({", ".join("?" * (len(main.question_columns) + 1))})""",
+            questions,
+        )
+        quiz_id = main.db.execute(
+            "INSERT INTO quizzes (quiz_name) VALUES ('Benchmark') RETURNING id"
+        ).fetchone()[0]
+        main.db.conn.executemany(
+            "INSERT INTO quiz_questions (quiz_id, question_id) VALUES (?, ?)",
+            [
+                (quiz_id, question_id)
+                for question_id in rng.sample(range(1, question_count + 1), quiz_size)
+            ],
+        )
+    return quiz_id
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+
+    async def request(self, client, name, method, url, **kwargs):
+        started = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+        assert response.status_code < 400, f"{method} {url}: {response.status_code}"
+        return response
+
+
+def hidden_inputs(html: str):
+    values = {}
+    for tag in re.findall(r"<input[^>]*>", html):
+        attributes = dict(re.findall(r'([\w-]+)="([^"]*)"', tag))
+        if attributes.get("type") == "hidden":
+            values[attributes["name"]] = attributes.get("value", "")
+    return values
+
+
+async def take_exam(main, recorder, quiz_id, student_no, semaphore):
+    rng = random.Random(student_no)
+    transport = httpx.ASGITransport(app=main.app)
+    async with semaphore, httpx.AsyncClient(
+        transport=transport, base_url="http://testserver"
+    ) as client:
+        await recorder.request(
+            client,
+            "login",
+            "POST",
+            "/student/auth",
+            data={"username": f"student{student_no}"},
+        )
+        await recorder.request(client, "take", "GET", f"/student/take_quiz/{quiz_id}")
+        for question_no in range(1, quiz_size + 1):
+            page = await recorder.request(
+                client,
+                "question",
+                "GET",
+                f"/student/take_quiz/{quiz_id}/question/{question_no}",
+                headers={"HX-Request": "true"},
+            )
+            await recorder.request(
+                client,
+                "answer",
+                "POST",
+                "/student/quiz/answer",
+                data={
+                    **hidden_inputs(page.text),
+                    "selected_option": rng.choice("ABCD"),
+                },
+            )
+        student_quiz_id = re.search(r"/student/quiz/submit/(\d+)", page.text).group(1)
+        await recorder.request(
+            client, "submit", "POST", f"/student/quiz/submit/{student_quiz_id}"
+        )
+        await recorder.request(
+            client, "result", "GET", f"/student/quiz/{student_quiz_id}/result"
+        )
+
+
+async def run_exam(main, quiz_id):
+    recorder = Recorder()
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(
+            take_exam(main, recorder, quiz_id, student_no, semaphore)
+            for student_no in range(student_count)
+        )
+    )
+    # The teacher watches the result matrix once everyone has submitted
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://testserver"
+    ) as client:
+        for _ in range(result_views):
+            await recorder.request(
+                client, "result_matrix", "GET", f"/quiz_result/{quiz_id}"
+            )
+    return recorder.latencies, time.perf_counter() - started
+
+
+def reference_timings(runs: int = 5):
+    # A fixed SQLite and Python workload, so timings from different hosts compare as ratios
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, tag TEXT, body TEXT)")
+        conn.executemany(
+            "INSERT INTO t (tag, body) VALUES (?, ?)",
+            (
+                (f"T{n % 10}", json.dumps({"n": n, "text": "x" * 50}))
+                for n in range(20000)
+            ),
+        )
+        for n in range(200):
+            conn.execute(
+                "SELECT COUNT(*), MAX(body) FROM t WHERE tag = ?", [f"T{n % 10}"]
+            ).fetchone()
+        conn.close()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def sql_per_request(main, quiz_id):
+    # Statements each route runs for one more student once the caches are warm, counted
+    # by the request metrics middleware. Taken alone so no concurrent cache miss adds any
+    metrics = main.request_metrics
+    # Submit folds its own answers instead of finding them folded by the autosave thread
+    main.answer_buffer.stop()
+    requests = {key: sum(buckets) for key, buckets in metrics.buckets.items()}
+    queries = metrics.sql_queries.copy()
+    asyncio.run(
+        take_exam(main, Recorder(), quiz_id, student_count, asyncio.Semaphore(1))
+    )
+    statements = {}
+    for (method, route), buckets in sorted(metrics.buckets.items()):
+        count = sum(buckets) - requests.get((method, route), 0)
+        if count:
+            ran = metrics.sql_queries[(method, route)] - queries[(method, route)]
+            statements[f"{method} {route}"] = round(ran / count, 2)
+    return statements
+
+
+def percentile(values: list, fraction: float):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies: dict, elapsed: float):
+    return {
+        name: {
+            "requests": len(values),
+            "throughput_rps": round(len(values) / elapsed, 1),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+        }
+        for name, values in latencies.items()
+    }
+
+
+def test_exam_day_benchmark(main):
+    quiz_id = seed(main)
+    # Timed before and after the exam, so a host that slows down midway shows up in both
+    timings = reference_timings()
+    latencies, elapsed = asyncio.run(run_exam(main, quiz_id))
+    reference = round(statistics.median([*timings, *reference_timings()]), 2)
+    routes = summarize(latencies, elapsed)
+    for stats in routes.values():
+        stats["p50_ratio"] = round(stats["p50_ms"] / reference, 3)
+    statements = sql_per_request(main, quiz_id)
+
+    print(f"\nExam day benchmark {scale} in {elapsed:.2f}s, reference {reference} ms")
+    print(
+        f"{'route':<15}{'requests':>10}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    )
+    for name, stats in routes.items():
+        print(
+            f"{name:<15}{stats['requests']:>10}{stats['throughput_rps']:>10}"
+            f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}"
+        )
+    for route, count in statements.items():
+        print(f"{route:<45}{count:>10} SQL statements per request")
+
+    # Every student's attempt was scored
+    completed = main.db.execute(
+        "SELECT COUNT(*) FROM student_quiz_result WHERE completed = 1"
+    ).fetchone()[0]
+    assert completed == student_count + 1
+
+    if update_baseline:
+        baseline_path.write_text(
+            json.dumps(
+                {
+                    "scale": scale,
+                    "reference_ms": reference,
+                    "routes": routes,
+                    "sql_per_request": statements,
+                },
+                indent=2,
+            )
+            + "\n"
+        )
+        return
+    baseline = json.loads(baseline_path.read_text())
+    if baseline["scale"] != scale:
+        pytest.skip(f"Baseline was recorded at {baseline['scale']}, not {scale}")
+    # Statement counts don't depend on the host, any extra query is a regression
+    extra_sql = [
+        f"{route}: {statements.get(route)} SQL statements per request"
+        f" vs baseline {count}"
+        for route, count in baseline["sql_per_request"].items()
+        if statements.get(route, 0) > count
+    ]
+    assert not extra_sql, "More queries than the baseline:\n" + "\n".join(extra_sql)
+    slower = [
+        f"{name}: p50 {routes[name]['p50_ratio']}x the reference"
+        f" vs baseline {stats['p50_ratio']}x"
+        for name, stats in baseline["routes"].items()
+        if routes[name]["p50_ratio"] > stats["p50_ratio"] * tolerance
+    ]
+    assert not slower, "Slower than the baseline:\n" + "\n".join(slower)
@@ -1,6 +1,8 @@
+from pathlib import Path
+
 from playwright.sync_api import Page, expect
 
-upload_file_path = r"D:\Projects\lms\data\powerquery_quiz.xlsx"
+upload_file_path = Path(__file__).parent.parent / "data" / "powerquery_quiz.xlsx"
 
 
 def test_file_upload_and_display(page: Page) -> None: